@@ -0,0 +1,88 @@
+"""Compares writing 10k rows one statement at a time with the batch
+write API: `new_record` against `new_records` (COPY) and
+`upsert_record` and `executemany` against `upsert_many`."""
+
+import argparse
+import asyncio
+import datetime
+import time
+
+from cogs.utils.db import Database
+from cogs.utils.db.database import compile_insert
+from cogs.utils.db.fields import BigInteger, Index, Timestamp
+
+from .common import database_url
+
+TABLE = "bench_batch_writes"
+
+
+def rows(count, offset=0):
+    now = datetime.datetime.now()
+    return [
+        {"guild_id": n % 100, "channel_id": n + offset, "last_message": now}
+        for n in range(count)
+    ]
+
+
+async def timed(name, count, coro):
+    start = time.perf_counter()
+    result = await coro
+    elapsed = time.perf_counter() - start
+    print(f"{name:<36} {elapsed:>8.3f}s {count / elapsed:>10.0f} rows/s  -> {result}")
+
+
+async def per_row(func, records):
+    for record in records:
+        await func(**record)
+    return len(records)
+
+
+async def main(count):
+    database = Database(database_url())
+    await database.connect()
+    table = await database.new_table(
+        TABLE,
+        (
+            BigInteger("guild_id"),
+            BigInteger("channel_id"),
+            Timestamp("last_message"),
+            Index("channel_id", unique=True),
+        ),
+    )
+    conflict = ("channel_id",)
+    try:
+        await timed("new_record per row", count, per_row(table.new_record, rows(count)))
+        await table.delete_records()
+        await timed("new_records (COPY)", count, table.new_records(rows(count)))
+        await timed(
+            "upsert_record per row, all updates",
+            count,
+            per_row(lambda **r: table.upsert_record(conflict, **r), rows(count)),
+        )
+        fields = tuple(rows(1)[0])
+        await timed(
+            "executemany upsert, all updates",
+            count,
+            database.executemany(
+                compile_insert(TABLE, fields, conflict=conflict),
+                [list(r.values()) for r in rows(count)],
+            ),
+        )
+        await timed(
+            "upsert_many, all updates", count, table.upsert_many(conflict, rows(count))
+        )
+        await timed(
+            "upsert_many, all inserts",
+            count,
+            table.upsert_many(conflict, rows(count, offset=count)),
+        )
+    finally:
+        await database.execute_sql(f"DROP TABLE {TABLE}")
+        await database.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10000)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows))
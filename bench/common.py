@@ -0,0 +1,49 @@
+"""Helpers shared by the benchmarks.
+
+Run a benchmark from the repository root, e.g. `python -m bench.db_pool`.
+Benchmarks that need Postgres use the scratch database given by the
+BENCH_DATABASE_URL environment variable. They create and drop their own
+tables, but connecting also bootstraps the bot's schema there."""
+
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+
+def database_url():
+    url = os.environ.get("BENCH_DATABASE_URL")
+    if not url:
+        sys.exit("Set BENCH_DATABASE_URL to a scratch database to run this benchmark.")
+    return url
+
+
+async def throughput(func, total, concurrency=1):
+    """Await `func()` `total` times with up to `concurrency` calls
+    running at once, returns the calls per second and the latencies."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def call():
+        async with semaphore:
+            start = time.perf_counter()
+            await func()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[call() for _ in range(total)])
+    return total / (time.perf_counter() - start), latencies
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(name, rate, latencies, unit="queries"):
+    print(
+        f"{name:<44} {rate:>10.0f} {unit}/s"
+        f"  p50 {statistics.median(latencies) * 1000:>7.2f}ms"
+        f"  p99 {percentile(latencies, 0.99) * 1000:>7.2f}ms"
+    )
@@ -0,0 +1,46 @@
+"""Compares queries per second when every query opens its own
+connection with `asyncpg.connect`, as `Database` used to, against
+queries on the `Database` pool."""
+
+import argparse
+import asyncio
+
+import asyncpg
+
+from cogs.utils.db import Database
+
+from .common import database_url, report, throughput
+
+
+async def connect_per_query(url):
+    conn = await asyncpg.connect(url)
+    try:
+        await conn.fetchval("SELECT 1;")
+    finally:
+        await conn.close()
+
+
+async def main(queries, concurrency):
+    url = database_url()
+    database = Database(url, max_size=concurrency)
+    await database.connect()
+    try:
+        for workers in sorted({1, concurrency}):
+            rate, latencies = await throughput(
+                lambda: connect_per_query(url), queries, workers
+            )
+            report(f"connect per query, {workers} concurrent", rate, latencies)
+            rate, latencies = await throughput(
+                lambda: database.fetchval("SELECT 1;"), queries, workers
+            )
+            report(f"pool, {workers} concurrent", rate, latencies)
+    finally:
+        await database.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(main(args.queries, args.concurrency))
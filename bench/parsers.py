@@ -0,0 +1,81 @@
+"""Compares the parse time and peak memory of the lxml parsers in
+cogs.utils.moodle with the BeautifulSoup parsing they replaced, on the
+saved pages in tests/fixtures. Peak memory is read from /proc,
+so this benchmark only runs on Linux."""
+
+import argparse
+import multiprocessing
+import os
+import timeit
+
+from cogs.utils import moodle
+
+from . import soup_parsers
+
+FIXTURES = os.path.join(os.path.dirname(__file__), os.pardir, "tests", "fixtures")
+
+CASES = (
+    ("forum.html", moodle.parse_forum, soup_parsers.parse_forum),
+    ("forum_large.html", moodle.parse_forum, soup_parsers.parse_forum),
+    ("discussion.html", moodle.parse_discussion, soup_parsers.parse_discussion),
+    ("login.html", moodle.parse_login_form, soup_parsers.parse_login_form),
+)
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        return f.read()
+
+
+def peak_rss():
+    """The peak resident set size of this process in KiB. Unlike
+    ru_maxrss, VmHWM isn't carried over from the parent process."""
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+
+
+def peak_memory(func, content, queue):
+    """Runs in a fresh process, reports how much the parse
+    raised the peak resident set size in KiB."""
+    # The moodle parsers import these lazily, don't count them.
+    import dateutil.parser
+    import lxml.html
+
+    before = peak_rss()
+    func(content)
+    queue.put(peak_rss() - before)
+
+
+def measure_memory(func, content):
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=peak_memory, args=(func, content, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main(number):
+    print(f"{'page':<18} {'parser':<14} {'time':>10} {'peak rss':>10}")
+    for name, lxml_parser, soup_parser in CASES:
+        content = read_fixture(name)
+        for label, func, page in (
+            ("lxml", lxml_parser, content),
+            ("BeautifulSoup", soup_parser, content.decode()),
+        ):
+            seconds = min(timeit.repeat(lambda: func(page), number=number, repeat=5))
+            memory = measure_memory(func, page)
+            print(
+                f"{name:<18} {label:<14} {seconds / number * 1000:>8.2f}ms"
+                f" {memory:>7}KiB"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=20)
+    args = parser.parse_args()
+    main(args.number)
@@ -0,0 +1,83 @@
+"""Measures how many messages a second can have their command prefix
+resolved with 10k guilds in server_setting, comparing the in-memory
+index behind `guild_prefix` with a database query on every message."""
+
+import argparse
+import asyncio
+import functools
+import random
+from types import SimpleNamespace
+
+from discord.ext import commands
+
+from bot import LancasterUniBot, guild_prefix
+from cogs.utils.db import Database
+from cogs.utils.db.database import DBFilter
+
+from .common import database_url, report, throughput
+
+# Far away from any real guild ID, so the rows can be removed afterwards.
+FIRST_GUILD = 10**17
+
+
+async def queried_prefix(bot, message):
+    """Look the prefix up in the database, as a resolver without
+    the in-memory index would have to."""
+    records = await bot.database.table(bot.database.settings_table).filter(
+        where=DBFilter(guild_id=message.guild.id, key="prefix")
+    )
+    return records[0]["value"] if records else bot.default_prefix
+
+
+async def cached_prefix(bot, message):
+    """Go through the evicting settings cache instead."""
+    prefix = await bot.database.get_setting(message.guild, "prefix")
+    return prefix or bot.default_prefix
+
+
+def stand_in_bot(database, resolver):
+    """Just enough of LancasterUniBot for `Bot.get_prefix`."""
+    bot = SimpleNamespace(
+        database=database, default_prefix="!", command_prefix=resolver
+    )
+    bot.prefix_for = functools.partial(LancasterUniBot.prefix_for, bot)
+    return bot
+
+
+async def main(guilds, messages, concurrency):
+    database = Database(database_url())
+    await database.connect()
+    table = database.table(database.settings_table)
+    guild_ids = range(FIRST_GUILD, FIRST_GUILD + guilds)
+    try:
+        await table.new_records(
+            {"guild_id": guild_id, "key": "prefix", "value": f"{n % 100}!"}
+            for n, guild_id in enumerate(guild_ids)
+        )
+        await database.load_settings()
+
+        def message():
+            return SimpleNamespace(guild=SimpleNamespace(id=random.choice(guild_ids)))
+
+        for name, resolver, total in (
+            ("in-memory index", guild_prefix, messages),
+            ("settings cache", cached_prefix, messages // 10),
+            ("query per message", queried_prefix, messages // 10),
+        ):
+            bot = stand_in_bot(database, resolver)
+            rate, latencies = await throughput(
+                lambda: commands.Bot.get_prefix(bot, message()), total, concurrency
+            )
+            report(f"{name}, {guilds} guilds", rate, latencies, "messages")
+    finally:
+        await table.delete_records(where=DBFilter(guild_id__ge=FIRST_GUILD))
+        await database.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--guilds", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    args = parser.parse_args()
+    asyncio.run(main(args.guilds, args.messages, args.concurrency))
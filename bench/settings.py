@@ -0,0 +1,69 @@
+"""Measures the latency of writing and reading a guild setting with
+10k+ rows in server_setting, comparing the old DELETE then INSERT on
+separate connections with the single upsert in `set_setting`."""
+
+import argparse
+import asyncio
+import itertools
+import random
+from types import SimpleNamespace
+
+from cogs.utils.db import Database
+from cogs.utils.db.database import DBFilter
+
+from .common import database_url, report, throughput
+
+# Far away from any real guild ID, so the rows can be removed afterwards.
+FIRST_GUILD = 10**17
+
+
+async def delete_then_insert(database, guild, key, value):
+    table = database.table(database.settings_table)
+    await table.delete_records(where=DBFilter(guild_id=guild.id, key=key))
+    await table.new_record(guild_id=guild.id, key=key, value=value)
+
+
+async def main(rows, writes):
+    database = Database(database_url())
+    await database.connect()
+    table = database.table(database.settings_table)
+    guild_ids = range(FIRST_GUILD, FIRST_GUILD + rows // 10)
+    try:
+        await table.new_records(
+            {"guild_id": guild_id, "key": f"setting_{n}", "value": str(n)}
+            for guild_id in guild_ids
+            for n in range(10)
+        )
+        values = itertools.count()
+
+        def guild():
+            return SimpleNamespace(id=random.choice(guild_ids))
+
+        rate, latencies = await throughput(
+            lambda: delete_then_insert(
+                database, guild(), "setting_0", str(next(values))
+            ),
+            writes,
+        )
+        report(f"DELETE then INSERT, {rows} rows", rate, latencies, "writes")
+        rate, latencies = await throughput(
+            lambda: database.set_setting(guild(), "setting_0", next(values)),
+            writes,
+        )
+        report(f"set_setting upsert, {rows} rows", rate, latencies, "writes")
+        rate, latencies = await throughput(
+            lambda: table.filter(where=DBFilter(guild_id=guild().id, key="setting_0")),
+            writes,
+        )
+        report(f"uncached read, {rows} rows", rate, latencies, "reads")
+    finally:
+        await table.delete_records(where=DBFilter(guild_id__ge=FIRST_GUILD))
+        await database.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--writes", type=int, default=2000)
+    args = parser.parse_args()
+    asyncio.run(main(args.rows, args.writes))
@@ -0,0 +1,53 @@
+"""The BeautifulSoup parsing that cogs.utils.moodle replaced, kept
+to compare the output and speed of the lxml parsers against it."""
+
+import datetime
+import re
+
+from bs4 import BeautifulSoup
+from dateutil.parser import isoparse
+
+
+def parse_forum(content):
+    soup = BeautifulSoup(content, "lxml")
+    announcements = []
+    rows = soup.select_one("tbody").find_all("tr")
+    for row in rows:
+        icon, group, author, *other = row.find_all("td")
+        if not group.text.strip():
+            title = row.select_one("th").text.strip()
+            avatar = author.select_one("img")["src"]
+            _id = re.findall(r"[?&]d=(\d+)$", row.select_one("th a")["href"].strip())[0]
+
+            if title.endswith("Locked"):
+                title = title[:-6]
+
+            author_name, date = author.select_one(".author-info").find_all("div")
+
+            announcement = {
+                "title": title.strip(),
+                "author": author_name.text.strip(),
+                "date": datetime.datetime.strptime(date.text.strip(), "%d %b %Y"),
+                "url": "https://modules.lancaster.ac.uk/mod/forum/discuss.php?d="
+                + str(_id),
+                "avatar": avatar,
+                "id": _id,
+            }
+            announcements.append(announcement)
+    return announcements
+
+
+def parse_discussion(content):
+    soup = BeautifulSoup(content, "lxml")
+    return {
+        "description": "\n\n".join(
+            [x.text for x in soup.select_one(".post-content-container").find_all("p")]
+        )[:1000],
+        "date": isoparse(soup.select_one("time")["datetime"]),
+    }
+
+
+def parse_login_form(content):
+    soup = BeautifulSoup(content, "lxml")
+    form = soup.select_one("form#loginbox")
+    return {f["name"]: f["value"] for f in form.find_all("input")}
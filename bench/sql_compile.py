@@ -0,0 +1,137 @@
+"""Compares building SQL with the compiled-SQL cache against the
+f-string building it replaced, for `DBFilter.sql()` alone and for a
+filter query's round trip through the pool.
+
+Both build the same text for the same query shape, so asyncpg's
+statement cache is hit either way once a connection is pooled. The
+difference measured here is the Python time spent building the SQL."""
+
+import argparse
+import asyncio
+import timeit
+from collections import defaultdict
+
+from cogs.utils.db import Database
+from cogs.utils.db.database import DBFilter, compile_select
+from cogs.utils.db.fields import BigInteger, Text
+
+from .common import database_url, report, throughput
+
+TABLE = "bench_sql_compile"
+
+FILTERS = {
+    "guild_id, key": dict(guild_id=1, key="prefix"),
+    "guild_id, post_id__in (5)": dict(guild_id=1, post_id__in=list("abcde")),
+    "id__gt, value__ne=None": dict(id__gt=10, value__ne=None),
+}
+
+
+def legacy_filter_sql(filter_kwargs, placeholders_from=1):
+    """DBFilter.sql() as it was before the compiled-SQL cache."""
+    conditions = defaultdict(list)
+    values = list(filter_kwargs.values())
+    removes = []
+
+    for num, field_name in enumerate(filter_kwargs.keys(), start=placeholders_from):
+        n = num - len(removes)
+        i = num - placeholders_from
+        if field_name.endswith("__in"):
+            array_sql = (
+                "(" + ", ".join([f"${x}" for x in range(n, n + len(values[i]))]) + ")"
+            )
+            array = values.pop(i)
+            for item in array[::-1]:
+                values.insert(i, item)
+            conditions[field_name[:-4]].append(f"{field_name[:-4]} IN {array_sql}")
+        elif field_name.endswith("__gt"):
+            conditions[field_name[:-4]].append(f"{field_name[:-4:]} > ${n}")
+        elif field_name.endswith("__ge"):
+            conditions[field_name[:-4]].append(f"{field_name[:-4:]} >= ${n}")
+        elif field_name.endswith("__lt"):
+            conditions[field_name[:-4]].append(f"{field_name[:-4:]} < ${n}")
+        elif field_name.endswith("__le"):
+            conditions[field_name[:-4]].append(f"{field_name[:-4:]} <= ${n}")
+        elif field_name.endswith("__ne"):
+            if values[i] is None:
+                conditions[field_name[:-4]].append(f"{field_name[:-4:]} IS NOT NULL")
+                removes.append(i)
+            else:
+                conditions[field_name[:-4]].append(f"{field_name[:-4:]} != ${n}")
+        else:
+            if values[i] is None:
+                conditions[field_name].append(f"{field_name} IS NULL")
+                removes.append(i)
+            else:
+                conditions[field_name].append(f"{field_name} = ${n}")
+
+    filters = []
+    for field, conds in conditions.items():
+        if len(conds) > 1:
+            cond = "(" + " OR ".join(conds) + ")"
+        else:
+            cond = conds[0]
+        filters.append(cond)
+
+    values = [v for n, v in enumerate(values) if n not in removes]
+
+    return "WHERE " + " AND ".join(filters), values
+
+
+def legacy_select(table, filter_kwargs):
+    where_sql, values = legacy_filter_sql(filter_kwargs)
+    return f"SELECT * FROM {table} {where_sql}  ;", values
+
+
+def select(table, filter_kwargs):
+    where_sql, values = DBFilter(**filter_kwargs).sql()
+    return compile_select(table, where_sql, None, False, None), values
+
+
+def bench_sql(number):
+    for name, kwargs in FILTERS.items():
+        assert legacy_filter_sql(kwargs) == DBFilter(**kwargs).sql()
+        for label, func in (
+            ("f-strings", lambda: legacy_filter_sql(kwargs)),
+            ("compiled", lambda: DBFilter(**kwargs).sql()),
+        ):
+            seconds = min(timeit.repeat(func, number=number, repeat=5))
+            print(
+                f"DBFilter.sql() {name:<28} {label:<10} {seconds / number * 1e6:>7.2f}us"
+            )
+
+
+async def bench_round_trip(queries):
+    database = Database(database_url())
+    await database.connect()
+    table = await database.new_table(
+        TABLE,
+        (BigInteger("guild_id"), Text("key"), Text("post_id"), Text("value")),
+    )
+    try:
+        await table.new_records(
+            {"guild_id": n % 100, "key": "prefix", "post_id": str(n), "value": "!"}
+            for n in range(10000)
+        )
+        for name, kwargs in FILTERS.items():
+            for label, build in (("f-strings", legacy_select), ("compiled", select)):
+
+                async def query():
+                    sql, values = build(TABLE, kwargs)
+                    await database.fetch(sql, *values)
+
+                rate, latencies = await throughput(query, queries)
+                report(f"{name} {label}", rate, latencies)
+    finally:
+        await database.execute_sql(f"DROP TABLE {TABLE}")
+        await database.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--no-database", action="store_true")
+    args = parser.parse_args()
+    bench_sql(args.number)
+    if not args.no_database:
+        asyncio.run(bench_round_trip(args.queries))
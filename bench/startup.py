@@ -0,0 +1,111 @@
+"""Measures how long the bot takes to start: importing each cog in a
+fresh interpreter, constructing the bot with its extensions, connecting
+to the database and each cog's setup.
+
+Setup is what a cog runs once the bot is ready, so the last part is the
+time from on_ready to the cog being usable. The bot isn't logged in, so
+the cogs' background tasks are stopped again straight after setup."""
+
+import argparse
+import asyncio
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+from bot import EXTENSIONS, LancasterUniBot
+
+from .common import database_url
+
+# Reported on their own, since they make up most of the import time.
+DEPENDENCIES = ("discord", "asyncpg", "aiohttp", "lxml")
+
+IMPORT_TIME = re.compile(r"import time:\s+\d+ \|\s+(\d+) \|\s*(\S+)$")
+
+
+def import_times(module):
+    """Import `module` in a fresh interpreter with `-X importtime`,
+    returns the cumulative seconds taken by each imported module. A
+    module's time leaves out anything an earlier import already loaded,
+    e.g. aiohttp when it was imported before discord."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        if match:
+            times[match.group(2)] = int(match.group(1)) / 1e6
+    return times
+
+
+def interpreter_time(code):
+    """Wall time of a fresh interpreter running `code`."""
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], check=True)
+    return time.perf_counter() - start
+
+
+def report_step(name, seconds):
+    print(f"  {name:<40} {seconds * 1000:>8.1f}ms")
+
+
+def report_imports(module, runs):
+    print(f"import {module}, median of {runs} fresh interpreters")
+    samples = [import_times(module) for _ in range(runs)]
+    for name in (module, *DEPENDENCIES):
+        times = [s[name] for s in samples if name in s]
+        if times:
+            report_step(name, statistics.median(times))
+        else:
+            print(f"  {name:<40} {'not imported':>10}")
+    empty = statistics.median([interpreter_time("pass") for _ in range(runs)])
+    wall = statistics.median(
+        [interpreter_time(f"import {module}") for _ in range(runs)]
+    )
+    report_step("wall time over an empty interpreter", wall - empty)
+
+
+class StandInUser:
+    """The bot isn't logged in, but the help embeds need its user."""
+
+    name = "Lancaster Uni Bot"
+
+    def avatar_url_as(self, **kwargs):
+        return ""
+
+
+async def report_setup():
+    print("start up against the scratch database")
+    start = time.perf_counter()
+    bot = LancasterUniBot(
+        "!", database_url(), ("username", "password"), {"portal_cookie_file": ""}
+    )
+    bot._connection.user = StandInUser()
+    report_step("construct the bot, load extensions", time.perf_counter() - start)
+    try:
+        start = time.perf_counter()
+        await bot.database.connect()
+        report_step("connect, bootstrap the database", time.perf_counter() - start)
+        for cog in list(bot.cogs.values()):
+            start = time.perf_counter()
+            await cog.setup()
+            report_step(f"{cog.qualified_name} setup", time.perf_counter() - start)
+    finally:
+        for extension in EXTENSIONS:
+            bot.unload_extension(extension)
+        await bot.database.close()
+        bot.executors.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    for extension in EXTENSIONS:
+        report_imports(extension, args.runs)
+    asyncio.run(report_setup())
@@ -1,34 +1,257 @@
+import time
+
+# Taken before the other imports, so that the times logged since
+# starting include importing discord, asyncpg and aiohttp.
+STARTED_AT = time.perf_counter()
+
 import logging
 import os
 import sys
 import configparser
+from collections import defaultdict
 
 from discord.ext import commands
 
 from cogs.utils.db import Database
+from cogs.utils.db.database import query_caller
 from cogs.utils.db.fields import *
+from cogs.utils.executor import Executors
+from cogs.utils.metrics import (
+    Histogram,
+    LoopLagMonitor,
+    MetricsServer,
+    format_labels,
+    render_histogram,
+)
+
+EXTENSIONS = ("cogs.general", "cogs.lancaster")
+
+DEFAULT_OPTIONS = {
+    "pool_min_size": "2",
+    "pool_max_size": "10",
+    "pool_timeout": "10",
+    "statement_cache_size": "100",
+    "settings_cache_size": "1000",
+    "forum_concurrency": "5",
+    "forum_timeout": "30",
+    "forum_retries": "3",
+    "portal_cookie_file": "portal_cookies.pickle",
+    "portal_connection_limit": "10",
+    "details_cache": "database",
+    "details_cache_size": "1000",
+    "details_cache_ttl": "604800",
+    "delivery_concurrency": "10",
+    "delivery_attempts": "3",
+    "history_concurrency": "5",
+    "slow_query_ms": "250",
+    "metrics_port": "",
+    "loop_lag_threshold_ms": "250",
+    "io_threads": "4",
+    "parse_processes": "2",
+    "poll_min_interval": "120",
+    "poll_max_interval": "3600",
+    "poll_hourly_budget": "120",
+    "shard_count": "",
+    "shard_ids": "",
+}
 
 
-class LancasterUniBot(commands.Bot):
-    def __init__(self, prefix, database_url, login_data):
-        super().__init__(command_prefix=prefix)
+def guild_prefix(bot, message):
+    return bot.prefix_for(message.guild)
+
+
+class LancasterUniBot(commands.AutoShardedBot):
+    def __init__(self, prefix, database_url, login_data, options=None):
+        options = {**DEFAULT_OPTIONS, **(options or {})}
+        shard_count = int(options["shard_count"]) if options["shard_count"] else None
+        shard_ids = None
+        if options["shard_ids"]:
+            shard_ids = [int(i) for i in options["shard_ids"].split(",")]
+        super().__init__(
+            command_prefix=guild_prefix, shard_count=shard_count, shard_ids=shard_ids
+        )
+        self.default_prefix = prefix
         self.login_data = login_data
         self.database_url = database_url
-        self.database = Database(self.database_url)
-        self.load_extension("cogs.general")
-        self.load_extension("cogs.lancaster")
+        self.options = options
+        self.database = Database(
+            self.database_url,
+            min_size=int(self.options["pool_min_size"]),
+            max_size=int(self.options["pool_max_size"]),
+            timeout=float(self.options["pool_timeout"]),
+            statement_cache_size=int(self.options["statement_cache_size"]),
+            settings_cache_size=int(self.options["settings_cache_size"]),
+            slow_query_threshold=float(self.options["slow_query_ms"]) / 1000,
+        )
+        self.executors = Executors(
+            threads=int(self.options["io_threads"]),
+            processes=int(self.options["parse_processes"]),
+        )
+        self.shard_messages = defaultdict(int)
+        self.command_latency = defaultdict(Histogram)
+        self.command_invocations = defaultdict(int)
+        self.command_errors = defaultdict(int)
+        self.loop_monitor = LoopLagMonitor(
+            threshold=float(self.options["loop_lag_threshold_ms"]) / 1000
+        )
+        self.metrics_server = None
+        if self.options["metrics_port"]:
+            self.metrics_server = MetricsServer(int(self.options["metrics_port"]))
+            self.metrics_server.add_collector(self.database.render_metrics)
+            self.metrics_server.add_collector(self.render_metrics)
+        self.add_listener(self.count_message, "on_message")
+        self.add_listener(self.count_command, "on_command")
+        self.add_listener(self.count_command_error, "on_command_error")
+        self.before_invoke(self.before_command)
+        self.after_invoke(self.after_command)
         self.logger = logging.getLogger(__name__)
+        self.started_at = STARTED_AT
+        self.ready_at = None
+        for extension in EXTENSIONS:
+            start = time.perf_counter()
+            self.load_extension(extension)
+            self.logger.info(
+                f"Loaded {extension} in {time.perf_counter() - start:.2f}s."
+            )
+
+    def prefix_for(self, guild):
+        """Get the prefix of a guild without touching the database,
+        guilds that haven't set one use the default prefix."""
+        if guild is None:
+            return self.default_prefix
+        return self.database.prefixes.get(guild.id, self.default_prefix)
+
+    def owns_guild(self, guild):
+        """Whether a guild belongs to one of the shards run by this process."""
+        return self.shard_ids is None or guild.shard_id in self.shard_ids
+
+    def owned_guilds(self):
+        return [guild for guild in self.guilds if self.owns_guild(guild)]
+
+    async def count_message(self, message):
+        if message.guild is not None:
+            self.shard_messages[message.guild.shard_id] += 1
+
+    def shard_stats(self):
+        """Get the gateway latency, guild count and message
+        count of every shard run by this process."""
+        guilds = defaultdict(int)
+        for guild in self.guilds:
+            guilds[guild.shard_id] += 1
+        return {
+            shard_id: {
+                "latency": latency,
+                "guilds": guilds[shard_id],
+                "messages": self.shard_messages[shard_id],
+            }
+            for shard_id, latency in self.latencies
+        }
+
+    async def before_command(self, ctx):
+        query_caller.set(f"{ctx.command.cog_name}.{ctx.command.qualified_name}")
+        ctx.started_at = time.perf_counter()
+
+    async def after_command(self, ctx):
+        name = ctx.command.qualified_name
+        self.command_latency[name].observe(time.perf_counter() - ctx.started_at)
+
+    # Invocations and errors are counted by listeners rather than the
+    # invoke hooks, which don't run when a check, converter or cooldown
+    # fails.
+    async def count_command(self, ctx):
+        self.command_invocations[ctx.command.qualified_name] += 1
+
+    async def count_command_error(self, ctx, exception):
+        if ctx.command is not None:
+            self.command_errors[ctx.command.qualified_name] += 1
+
+    def command_stats(self):
+        """Get the latency, invocations and errors of every
+        command and the event loop lag."""
+        return {
+            "commands": {
+                name: {
+                    **self.command_latency[name].to_dict(),
+                    "invocations": invocations,
+                    "errors": self.command_errors[name],
+                    "error_rate": self.command_errors[name] / invocations,
+                }
+                for name, invocations in self.command_invocations.items()
+            },
+            "loop_lag": {
+                **self.loop_monitor.lag.to_dict(),
+                "blocked": self.loop_monitor.blocked,
+            },
+        }
+
+    def render_metrics(self):
+        """Renders the command metrics in the Prometheus text format."""
+        lines = ["# TYPE command_seconds histogram"]
+        for name, histogram in self.command_latency.items():
+            lines += render_histogram("command_seconds", histogram, {"command": name})
+        lines.append("# TYPE command_invocations_total counter")
+        for name, invocations in self.command_invocations.items():
+            lines.append(
+                f"command_invocations_total{format_labels({'command': name})} "
+                f"{invocations}"
+            )
+        lines.append("# TYPE command_errors_total counter")
+        for name, errors in self.command_errors.items():
+            lines.append(
+                f"command_errors_total{format_labels({'command': name})} {errors}"
+            )
+        lines.append("# TYPE gateway_latency_seconds gauge")
+        lines.append("# TYPE gateway_messages_total counter")
+        for shard_id, shard in self.shard_stats().items():
+            labels = format_labels({"shard": shard_id})
+            lines.append(f"gateway_latency_seconds{labels} {shard['latency']}")
+            lines.append(f"gateway_messages_total{labels} {shard['messages']}")
+        lines.append("# TYPE event_loop_lag_seconds histogram")
+        lines += render_histogram("event_loop_lag_seconds", self.loop_monitor.lag)
+        lines.append("# TYPE event_loop_blocked_total counter")
+        lines.append(f"event_loop_blocked_total {self.loop_monitor.blocked}")
+        return lines
 
     async def on_connect(self):
         await self.database.connect()
+        if self.loop_monitor.task is None:
+            self.loop_monitor.start(self.loop)
+        if self.metrics_server is not None and self.metrics_server.runner is None:
+            await self.metrics_server.start()
+
+    async def close(self):
+        self.loop_monitor.stop()
+        await super().close()
+        await self.database.close()
+        self.executors.shutdown()
+        if self.metrics_server is not None:
+            await self.metrics_server.close()
 
     async def on_ready(self):
+        if self.ready_at is None:
+            self.ready_at = time.perf_counter()
+            self.logger.info(
+                f"Ready {self.ready_at - self.started_at:.2f}s after starting."
+            )
         self.logger.info("Bot is ready and accepting commands.")
         self.logger.info(
             f"Invite link: https://discord.com/oauth2/authorize?client_id={self.user.id}&permissions=8&scope=bot"
         )
 
 
+def read_options(config):
+    """Reads the optional settings, the environment takes
+    priority over 'settings.cfg'."""
+    options = {}
+    for name in DEFAULT_OPTIONS:
+        value = os.environ.get(name.upper())
+        if value is None and config.has_section("BotSettings"):
+            value = config["BotSettings"].get(name)
+        if value:
+            options[name] = value
+    return options
+
+
 def generate_settings():
     config = configparser.ConfigParser()
     config["BotSettings"] = {
@@ -37,6 +260,7 @@ def generate_settings():
         "prefix": "",
         "portal_username": "",
         "portal_password": "",
+        **DEFAULT_OPTIONS,
     }
     with open("settings.cfg", "w") as f:
         config.write(f)
@@ -47,6 +271,9 @@ if __name__ == "__main__":
         level=logging.INFO, format="[%(levelname)s] [%(name)s] %(message)s"
     )
 
+    config = configparser.ConfigParser()
+    config.read("settings.cfg")
+
     try:
         token = os.environ["TOKEN"]
         database_url = os.environ["DATABASE_URL"]
@@ -62,9 +289,6 @@ if __name__ == "__main__":
             )
             sys.exit()
 
-        config = configparser.ConfigParser()
-        config.read("settings.cfg")
-
         try:
             token = config["BotSettings"]["token"]
             database_url = config["BotSettings"]["database_url"]
@@ -79,5 +303,5 @@ if __name__ == "__main__":
             )
             sys.exit()
 
-    bot = LancasterUniBot(prefix, database_url, login_data)
+    bot = LancasterUniBot(prefix, database_url, login_data, read_options(config))
     bot.run(token)
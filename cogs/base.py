@@ -1,5 +1,26 @@
 from discord.ext import commands
 import asyncio
+import functools
+import logging
+import time
+
+from .utils.db.database import query_caller
+
+
+def leader_only(name):
+    """Makes a cog method only run in the process that is the leader
+    for `name`, e.g. a tasks.loop that must only run once across
+    every instance of the bot."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            if await self.leader_election(name).acquire():
+                return await func(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
 
 
 class BaseCog(commands.Cog):
@@ -12,7 +33,21 @@ class BaseCog(commands.Cog):
 
     async def _setup(self):
         await self.bot.wait_until_ready()
+        # Returns straight away unless on_connect is still bootstrapping.
+        await self.bot.database.connect()
+        query_caller.set(f"{self.qualified_name}.setup")
         await self.setup()
+        logging.getLogger(__name__).info(
+            f"{self.qualified_name} set up "
+            f"{time.perf_counter() - self.bot.started_at:.2f}s after starting."
+        )
+
+    def leader_election(self, name):
+        """Get the leader election for `name`. Processes running different
+        shards hold separate elections since each serves its own guilds."""
+        if self.bot.shard_ids is not None:
+            name += ":" + ",".join(map(str, self.bot.shard_ids))
+        return self.bot.database.leader_election(name)
 
     async def setup(self):
         pass
\ No newline at end of file
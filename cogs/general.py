@@ -1,28 +1,127 @@
+import asyncio
 import datetime
+import heapq
 import inspect
 import io
-import subprocess
+import json
+import logging
+import time
 import traceback
 from contextlib import redirect_stdout
 
 import discord
 import humanize
-from discord.ext import commands
+from discord.ext import commands, tasks
 
-from .utils.db.database import DBFilter
+from .utils.db.database import DBFilter, query_caller
+from .utils.db.fields import *
 from .utils.messages import MessageBox
 
 from .base import BaseCog
 
+# Discord's limits on the length of an embed field, the
+# number of fields in an embed and the length of an embed.
+HELP_FIELD_LIMIT = 1024
+HELP_FIELDS_PER_EMBED = 25
+HELP_EMBED_LIMIT = 6000
+
 
 class General(BaseCog):
     def __init__(self, bot):
         super().__init__(bot)
         self.bot.remove_command("help")
         self.start_time = datetime.datetime.now()
+        self.logger = logging.getLogger(__name__)
         self.sessions = set()
+        self.channel_activity = None
+        self.last_activity = {}
+        self.dirty_channels = {}
+        self.help_embeds = {}
+        self.help_cogs = ()
+        self.history_semaphore = asyncio.Semaphore(
+            int(self.bot.options["history_concurrency"])
+        )
+
+    async def setup(self):
+        for prefix in {self.bot.default_prefix, *self.bot.database.prefixes.values()}:
+            self.get_help(prefix)
+        self.channel_activity = await self.bot.database.new_table(
+            "channel_activity",
+            (
+                BigInteger("guild_id"),
+                BigInteger("channel_id", unique=True),
+                Timestamp("last_message"),
+            ),
+        )
+        async for page in self.channel_activity.paginate():
+            for record in page:
+                channel_id = record["channel_id"]
+                if channel_id not in self.last_activity:
+                    self.last_activity[channel_id] = record["last_message"]
+        self.flush_activity_task.start()
+
+    def cog_unload(self):
+        self.flush_activity_task.cancel()
+        self.bot.loop.create_task(self.flush_activity())
+
+    def update_activity(self, channel, last_message):
+        """Record the time of the latest message in a channel."""
+        if last_message > self.last_activity.get(channel.id, datetime.datetime.min):
+            self.last_activity[channel.id] = last_message
+            self.dirty_channels[channel.id] = channel.guild.id
+
+    async def flush_activity(self):
+        """Write the channel activity that changed to the database."""
+        if not self.dirty_channels or self.channel_activity is None:
+            return
+        dirty, self.dirty_channels = self.dirty_channels, {}
+        try:
+            await self.channel_activity.upsert_many(
+                ("channel_id",),
+                [
+                    {
+                        "guild_id": guild_id,
+                        "channel_id": channel_id,
+                        "last_message": self.last_activity[channel_id],
+                    }
+                    for channel_id, guild_id in dirty.items()
+                ],
+            )
+        except Exception:
+            self.dirty_channels = {**dirty, **self.dirty_channels}
+            raise
+
+    @tasks.loop(minutes=1)
+    async def flush_activity_task(self):
+        query_caller.set(f"{self.qualified_name}.flush_activity")
+        # An error would stop the loop for good, the changes
+        # are kept and written on the next tick instead.
+        try:
+            await self.flush_activity()
+        except Exception:
+            self.logger.exception("Failed to save the channel activity.")
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        if message.guild is not None:
+            self.update_activity(message.channel, message.created_at)
+
+    async def probe_activity(self, channel):
+        """Fetch the time of the latest message in a channel,
+        a channel that can't be read is left without one."""
+        try:
+            async with self.history_semaphore:
+                last_message = await channel.history(limit=1).flatten()
+        except discord.HTTPException as e:
+            self.logger.warning(f"Failed to read the history of {channel.id}: {e!r}")
+            return
+        if last_message:
+            created_at = last_message[0].created_at
+        else:
+            created_at = datetime.datetime(1990, 1, 1)
+        self.update_activity(channel, created_at)
 
-    def get_usage(self, command):
+    def get_usage(self, command, prefix):
         """Gets the usage of a command."""
         arguments = []
 
@@ -34,40 +133,111 @@ class General(BaseCog):
             else:
                 arguments.append(f"[{param_name}]")
 
-        return f"{self.bot.command_prefix}{command.name} " + " ".join(arguments)
+        return f"{prefix}{command.name} " + " ".join(arguments)
+
+    def new_help_embed(self, **kwargs):
+        embed = discord.Embed(**kwargs)
+        embed.set_author(
+            name=self.bot.user.name,
+            icon_url=self.bot.user.avatar_url_as(format="png", static_format="png"),
+        )
+        return embed
+
+    def build_help(self, prefix):
+        """Build the help embeds for a prefix: the command listing,
+        split into pages if it doesn't fit in one embed, and an
+        embed for every command."""
+        listing = [
+            self.new_help_embed(
+                title="Commands are listed below",
+                description=f"Type `{prefix}help <command>`"
+                " more details on a command.",
+            )
+        ]
+        command_embeds = {}
+        for name, cog in self.bot.cogs.items():
+            for command in cog.get_commands():
+                embed = self.new_help_embed(
+                    title=prefix + command.name,
+                    description=command.callback.__doc__,
+                )
+                embed.add_field(
+                    name="Usage", value=f"`{self.get_usage(command, prefix)}`"
+                )
+                command_embeds[command.qualified_name] = embed
+
+            pages = [[]]
+            for command in [c for c in cog.get_commands() if not c.hidden]:
+                line = f"`{prefix}{command.name}`"
+                if len("\n".join(pages[-1] + [line])) > HELP_FIELD_LIMIT:
+                    pages.append([])
+                pages[-1].append(line)
+            for n, page in enumerate(pages, start=1):
+                if not page:
+                    continue
+                field_name = name + "  " + cog.emoji
+                if len(pages) > 1:
+                    field_name += f" ({n}/{len(pages)})"
+                value = "\n".join(page)
+                embed = listing[-1]
+                if (
+                    len(embed.fields) >= HELP_FIELDS_PER_EMBED
+                    or len(embed) + len(field_name) + len(value) > HELP_EMBED_LIMIT
+                ):
+                    embed = self.new_help_embed(title="Commands continued")
+                    listing.append(embed)
+                embed.add_field(name=field_name, value=value)
+
+        return {"listing": listing, "commands": command_embeds}
+
+    def get_help(self, prefix):
+        """Get the help embeds for a prefix, they are rebuilt whenever
+        a cog has been added, removed or reloaded since they were built."""
+        cogs = tuple(self.bot.cogs.values())
+        if len(cogs) != len(self.help_cogs) or any(
+            a is not b for a, b in zip(cogs, self.help_cogs)
+        ):
+            self.help_embeds.clear()
+            self.help_cogs = cogs
+        if prefix not in self.help_embeds:
+            self.help_embeds[prefix] = self.build_help(prefix)
+        return self.help_embeds[prefix]
 
     @commands.command()
     async def help(self, ctx, command=None):
         """Displays a list of bot commands."""
+        help_embeds = self.get_help(self.bot.prefix_for(ctx.guild))
         if command is None:
-            embed = discord.Embed(
-                title="Commands are listed below",
-                description=f"Type `{self.bot.command_prefix}help <command>`"
-                " more details on a command.",
-            )
+            for embed in help_embeds["listing"]:
+                await ctx.send(embed=embed)
+        elif (command := self.bot.get_command(command)) and (
+            embed := help_embeds["commands"].get(command.qualified_name)
+        ):
+            await ctx.send(embed=embed)
+        else:
+            await ctx.send(embed=MessageBox.warning("That command doesn't exist"))
 
-            for name, cog in self.bot.cogs.items():
-                cog_commands = [c for c in cog.get_commands() if not c.hidden]
-                if cog_commands:
-                    commands_list = "\n".join(
-                        [f"`{self.bot.command_prefix}{cc.name}`" for cc in cog_commands]
-                    )
-                    embed.add_field(name=name + "  " + cog.emoji, value=commands_list)
-
-        elif command := self.bot.get_command(command):
-            embed = discord.Embed(
-                title=self.bot.command_prefix + command.name,
-                description=command.callback.__doc__,
+    @commands.guild_only()
+    @commands.command()
+    async def prefix(self, ctx, prefix=None):
+        """Displays or changes the command prefix of the server."""
+        if prefix is None:
+            current = self.bot.prefix_for(ctx.guild)
+            return await ctx.send(
+                embed=MessageBox.info(f"The command prefix is `{current}`")
             )
-            embed.add_field(name="Usage", value=f"`{self.get_usage(command)}`")
-
-        embed.set_author(
-            name=self.bot.user.name,
-            icon_url=self.bot.user.avatar_url_as(format="png", static_format="png"),
+        if not ctx.author.guild_permissions.manage_guild:
+            return await ctx.send(
+                embed=MessageBox.warning("You need Manage Server to change the prefix")
+            )
+        if prefix == self.bot.default_prefix:
+            await self.bot.database.set_setting(ctx.guild, "prefix", None)
+        else:
+            await self.bot.database.set_setting(ctx.guild, "prefix", prefix)
+        await ctx.send(
+            embed=MessageBox.confirmed(f"The command prefix is now `{prefix}`")
         )
 
-        await ctx.send(embed=embed)
-
     @commands.is_owner()
     @commands.command(hidden=True)
     async def update(self, ctx):
@@ -75,8 +245,13 @@ class General(BaseCog):
         message = await ctx.send(
             embed=MessageBox.loading("Checking GitHub for updates.")
         )
-        out = subprocess.run("git pull", capture_output=True, shell=True)
-        status = out.stdout.decode().strip().split("\n")[-1]
+        process = await asyncio.create_subprocess_shell(
+            "git pull",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, _ = await process.communicate()
+        status = stdout.decode().strip().split("\n")[-1]
         if status == "Already up to date.":
             await message.edit(embed=MessageBox.info(status))
         else:
@@ -123,10 +298,103 @@ class General(BaseCog):
     @commands.command(hidden=True)
     async def storage(self, ctx):
         """Get the size of the database."""
-        async with self.bot.database.connection() as conn:
-            size = await conn.fetchrow("SELECT pg_database_size('ludb')")
-        human_size = humanize.naturalsize(size["pg_database_size"])
-        await ctx.send(embed=MessageBox.info(f"Database Size: `{human_size}`"))
+        size = await self.bot.database.fetchval("SELECT pg_database_size('ludb');")
+        human_size = humanize.naturalsize(size)
+        settings = self.bot.database.settings
+        await ctx.send(
+            embed=MessageBox.info(
+                f"Database Size: `{human_size}`\n"
+                f"Settings Cache: `{len(settings)}` guilds, "
+                f"`{settings.hits}` hits, `{settings.misses}` misses"
+            )
+        )
+
+    @commands.is_owner()
+    @commands.command(hidden=True)
+    async def dbstats(self, ctx):
+        """Displays the queries that take the most time."""
+        database = self.bot.database
+        slowest = sorted(
+            database.query_latency.items(), key=lambda x: x[1].sum, reverse=True
+        )[:10]
+
+        embed = discord.Embed(
+            title="Database Statistics",
+            description=f"Connection Wait (p95): "
+            f"`{database.acquire_wait.percentile(95) * 1000:.1f}ms`\n"
+            f"Slow Queries: `{database.slow_queries}`",
+        )
+        for (sql, caller), histogram in slowest:
+            embed.add_field(
+                name=caller,
+                value=f"`{sql[:200]}`\n"
+                f"Count: `{histogram.count}`, "
+                f"Rows: `{database.query_rows[(sql, caller)]}`\n"
+                f"p50: `{histogram.percentile(50) * 1000:.1f}ms`, "
+                f"p95: `{histogram.percentile(95) * 1000:.1f}ms`, "
+                f"p99: `{histogram.percentile(99) * 1000:.1f}ms`",
+                inline=False,
+            )
+        await ctx.send(embed=embed)
+
+    @commands.is_owner()
+    @commands.command(hidden=True)
+    async def stats(self, ctx, output=None):
+        """Displays command latency and event loop lag, type
+        `json` after the command to get them as a file."""
+        stats = self.bot.command_stats()
+        if output == "json":
+            data = io.BytesIO(json.dumps(stats, indent=4).encode())
+            return await ctx.send(file=discord.File(data, "stats.json"))
+
+        loop_lag = stats["loop_lag"]
+        embed = discord.Embed(
+            title="Bot Statistics",
+            description=f"Event Loop Lag: p95 `{loop_lag['p95'] * 1000:.1f}ms`, "
+            f"p99 `{loop_lag['p99'] * 1000:.1f}ms`\n"
+            f"Event Loop Blocked: `{loop_lag['blocked']}` times",
+        )
+        slowest = sorted(
+            stats["commands"].items(), key=lambda x: x[1]["p95"], reverse=True
+        )
+        for name, command in slowest[:25]:
+            embed.add_field(
+                name=name,
+                value=f"Count: `{command['invocations']}`, "
+                f"Errors: `{command['error_rate']:.0%}`\n"
+                f"p50: `{command['p50'] * 1000:.0f}ms`, "
+                f"p95: `{command['p95'] * 1000:.0f}ms`, "
+                f"p99: `{command['p99'] * 1000:.0f}ms`",
+            )
+        await ctx.send(embed=embed)
+
+    @commands.is_owner()
+    @commands.command(hidden=True)
+    async def seqscans(self, ctx):
+        """List the queries that can't use an index."""
+        scans = await self.bot.database.find_sequential_scans()
+        if scans:
+            msg = "\n".join([f"`{table}`: `{sql[:150]}`" for table, sql in scans])
+            await ctx.send(embed=MessageBox.warning(msg[:2000]))
+        else:
+            await ctx.send(embed=MessageBox.success("Every query can use an index."))
+
+    @commands.is_owner()
+    @commands.command(hidden=True)
+    async def shards(self, ctx):
+        """Displays the latency and activity of each shard."""
+        # The bot's start rather than the cog's, the counts carry on
+        # across reloads of this extension.
+        uptime = time.perf_counter() - self.bot.started_at
+        embed = discord.Embed(title="Shards")
+        for shard_id, shard in self.bot.shard_stats().items():
+            embed.add_field(
+                name=f"Shard {shard_id}",
+                value=f"Latency: `{shard['latency'] * 1000:.0f}ms`\n"
+                f"Guilds: `{shard['guilds']}`\n"
+                f"Messages: `{shard['messages'] / uptime * 60:.1f}/min`",
+            )
+        await ctx.send(embed=embed)
 
     @commands.command()
     async def uptime(self, ctx):
@@ -191,17 +459,28 @@ class General(BaseCog):
     async def deadchannels(self, ctx, limit: int = 10):
         """Returns the top 10 channels which are most dead in the server."""
         message = await ctx.send(embed=MessageBox.loading("Gathering channel data."))
-        channels = []
-        for ch in ctx.guild.channels:
-            if isinstance(ch, discord.TextChannel):
-                last_message = await ch.history(limit=1).flatten()
-                if last_message:
-                    channels.append((ch, last_message[0].created_at))
-                else:
-                    channels.append((ch, datetime.datetime(1990, 1, 1)))
-        dead_channels = list(sorted(channels, key=lambda x: x[1]))[:limit]
+        channels = [
+            ch for ch in ctx.guild.channels if isinstance(ch, discord.TextChannel)
+        ]
+        for ch in channels:
+            if ch.last_message_id is not None:
+                created_at = discord.utils.snowflake_time(ch.last_message_id)
+                self.update_activity(ch, created_at)
+        await asyncio.gather(
+            *[
+                self.probe_activity(ch)
+                for ch in channels
+                if ch.id not in self.last_activity
+                and ch.permissions_for(ctx.guild.me).read_message_history
+            ]
+        )
+        # Channels whose history couldn't be read are left out.
+        channels = [ch for ch in channels if ch.id in self.last_activity]
+        dead_channels = heapq.nsmallest(
+            limit, channels, key=lambda ch: self.last_activity[ch.id]
+        )
         msg = "\n".join(
-            [f"{n}. {ch[0].mention}" for n, ch in enumerate(dead_channels, start=1)]
+            [f"{n}. {ch.mention}" for n, ch in enumerate(dead_channels, start=1)]
         )
         await message.edit(embed=MessageBox.info(msg))
 
@@ -1,125 +1,240 @@
+import asyncio
 import datetime
+import hashlib
 import json
 import logging
 import os
-import re
-from contextlib import asynccontextmanager
+import time
+from collections import Counter, defaultdict
+from concurrent.futures.process import BrokenProcessPool
 
 import aiohttp
 import discord
-import xmltodict
-from async_lru import alru_cache
-from bs4 import BeautifulSoup
-from dateutil import parser
 from discord.ext import commands, tasks
-from dateutil.parser import isoparse
 
-from .base import BaseCog
-from .utils.db.database import DBFilter
+from .base import BaseCog, leader_only
+from .utils.db.database import DBFilter, query_caller
 from .utils.db.fields import *
+from .utils import moodle
+from .utils.cache import DatabaseCache, TTLCache
+from .utils.portal import PortalLoginError, PortalSession
+from .utils.scheduler import AdaptiveScheduler
+
+FORUMS_PATH = os.path.join("data", "forums.json")
 
 
 class Lancaster(BaseCog):
     def __init__(self, bot):
         super().__init__(bot)
         self.emoji = "🌹"
-        self.session = None
+        self.portal = PortalSession(
+            *self.bot.login_data,
+            cookie_path=self.bot.options["portal_cookie_file"],
+            limit=int(self.bot.options["portal_connection_limit"]),
+        )
         self.logger = logging.getLogger(__name__)
+        self.forum_semaphore = asyncio.Semaphore(
+            int(self.bot.options["forum_concurrency"])
+        )
+        cache_options = {
+            "maxsize": int(self.bot.options["details_cache_size"]),
+            "ttl": int(self.bot.options["details_cache_ttl"]),
+        }
+        if self.bot.options["details_cache"] == "database":
+            self.details_cache = DatabaseCache(
+                self.bot.database, "post_details", **cache_options
+            )
+        else:
+            self.details_cache = TTLCache(**cache_options)
+        self.delivery_semaphore = asyncio.Semaphore(
+            int(self.bot.options["delivery_concurrency"])
+        )
+        # Passes read what has been posted before sending, so two at
+        # once could send the same announcement twice.
+        self.pass_lock = asyncio.Lock()
+        self.last_pass = None
+        self.forums = []
+        self.forums_mtime = None
+        self.scheduler = AdaptiveScheduler(
+            min_interval=int(self.bot.options["poll_min_interval"]),
+            max_interval=int(self.bot.options["poll_max_interval"]),
+            hourly_budget=int(self.bot.options["poll_hourly_budget"]),
+        )
+        self.high_water = {}
+        self.fetched_at = {}
+        self.failed_deliveries = {}
+        self.forum_state = defaultdict(dict)
+        self.forum_stats = defaultdict(Counter)
 
     async def setup(self):
         self.moodle_posts = await self.bot.database.new_table(
             "demographics_roles",
-            (BigInteger("guild_id"), Varchar("post_id", 1000)),
+            (
+                BigInteger("guild_id"),
+                Varchar("post_id", 1000),
+                Index("guild_id", "post_id", unique=True),
+            ),
         )
+        self.forum_marks = await self.bot.database.new_table(
+            "forum_high_water",
+            (
+                Text("scope"),
+                BigInteger("forum_id"),
+                BigInteger("post_id"),
+                Index("scope", "forum_id", unique=True),
+            ),
+        )
+        await self.details_cache.load()
         self.check_for_announcements_task.start()
 
-    @alru_cache(maxsize=10)
-    async def login_to_portal(self, username, password):
-        session = aiohttp.ClientSession()
-
-        async with session.get("https://weblogin.lancs.ac.uk/login/") as login_page:
-            html = await login_page.text()
-            soup = BeautifulSoup(html, "lxml")
-            form = soup.select_one("form#loginbox")
-            data = {f["name"]: f["value"] for f in form.find_all("input")}
-            data["username"] = username
-
-        async with session.post(
-            "https://weblogin.lancs.ac.uk/login/", data=data
-        ) as pw_page:
-            html = await pw_page.text()
-            soup = BeautifulSoup(html, "lxml")
-            form = soup.select_one("form#loginbox")
-            data = {f["name"]: f["value"] for f in form.find_all("input")}
-            data["password"] = password
-
-        resp = await session.post("https://weblogin.lancs.ac.uk/login/", data=data)
-        html = await resp.text()
-        if "You are logged into" in html:
-            return session
-
-    async def get_news(self):
-        with open(os.path.join("data", "forums.json")) as forums_file:
-            forum_data = json.load(forums_file)
+    def cog_unload(self):
+        self.check_for_announcements_task.cancel()
+        self.bot.loop.create_task(self.portal.close())
+
+    @property
+    def marks_scope(self):
+        """Each set of shards elects its own leader, so each
+        keeps its own high-water marks."""
+        return self.leader_election("announcements").name
+
+    def read_forums(self):
+        with open(FORUMS_PATH) as forums_file:
+            return json.load(forums_file)
+
+    async def get_forums(self):
+        """Get the forums to check, the file is only read
+        again when it has been modified."""
+        mtime = (await self.bot.executors.run_in_thread(os.stat, FORUMS_PATH)).st_mtime
+        if mtime != self.forums_mtime:
+            self.forums = await self.bot.executors.run_in_thread(self.read_forums)
+            self.forums_mtime = mtime
+        return self.forums
+
+    async def get_news(self, forum_data=None, incremental=True, scheduled=False):
+        """Get the announcements of every forum, newest first. If
+        `incremental` is True, forums stop being parsed once they reach
+        discussions with no posts since they were last fetched. Only
+        `scheduled` polls move the forums' next poll."""
+        if forum_data is None:
+            forum_data = await self.get_forums()
 
         announcements = []
-        session = await self.login_to_portal(*self.bot.login_data)
-        for forum in forum_data:
-            resp = await session.get(
-                f"https://modules.lancaster.ac.uk/mod/forum/view.php?id={forum['id']}"
-            )
-            content = await resp.text()
-            soup = BeautifulSoup(content, "lxml")
-            rows = soup.select_one("tbody").find_all("tr")
-            for row in rows:
-                icon, group, author, *other = row.find_all("td")
-                if not group.text.strip():
-                    title = row.select_one("th").text.strip()
-                    avatar = author.select_one("img")["src"]
-                    _id = re.findall(
-                        r"[?&]d=(\d+)$", row.select_one("th a")["href"].strip()
-                    )[0]
-
-                    if title.endswith("Locked"):
-                        title = title[:-6]
-
-                    author_name, date = author.select_one(".author-info").find_all(
-                        "div"
+        fetched_at = datetime.datetime.now()
+        results = await asyncio.gather(
+            *[
+                self.fetch_forum(
+                    forum, self.fetched_at.get(forum["id"]) if incremental else None
+                )
+                for forum in forum_data
+            ],
+            return_exceptions=True,
+        )
+        for forum, result in zip(forum_data, results):
+            if isinstance(result, Exception):
+                self.logger.warning(f"Failed to fetch {forum['name']}: {result!r}")
+                if scheduled:
+                    self.scheduler.record(forum["id"], active=False)
+            else:
+                self.fetched_at[forum["id"]] = fetched_at
+                announcements += [{**a, "forum": forum["id"]} for a in result]
+                if scheduled:
+                    mark = self.high_water.get(forum["id"])
+                    active = mark is not None and any(
+                        int(a["id"]) > mark for a in result
                     )
-
-                    announcement = {
-                        "title": title.strip(),
-                        "author": author_name.text.strip(),
-                        "date": datetime.datetime.strptime(
-                            date.text.strip(), "%d %b %Y"
-                        ),
-                        "url": "https://modules.lancaster.ac.uk/mod/forum/discuss.php?d="
-                        + str(_id),
-                        "avatar": avatar,
-                        "id": _id,
-                    }
-                    announcements.append(announcement)
+                    self.scheduler.record(forum["id"], active=active)
 
         latest = sorted(announcements, key=lambda x: x["date"], reverse=True)
         return latest
 
-    @alru_cache(maxsize=100)
-    async def get_extra_details(self, _id):
-        session = await self.login_to_portal(*self.bot.login_data)
-        resp = await session.get(
-            f"https://modules.lancaster.ac.uk/mod/forum/discuss.php?d={_id}"
+    async def fetch_forum(self, forum, since=None):
+        """Fetch the announcements of a forum, retrying with an
+        exponential backoff if the request fails.
+
+        The page is requested conditionally and is only parsed again
+        if it has changed since the last time it was fetched, or if
+        the last parse stopped before the discussions asked for."""
+        state = self.forum_state[forum["id"]]
+        stats = self.forum_stats[forum["id"]]
+        # A parse that stopped at an earlier time covers every later one.
+        reusable = "announcements" in state and (
+            state["since"] is None or (since is not None and since >= state["since"])
         )
-        content = await resp.text()
-        soup = BeautifulSoup(content, "lxml")
-        return {
-            "description": "\n\n".join(
-                [
-                    x.text
-                    for x in soup.select_one(".post-content-container").find_all("p")
-                ]
-            )[:1000],
-            "date": isoparse(soup.select_one("time")["datetime"]),
-        }
+        headers = {}
+        if reusable and "etag" in state:
+            headers["If-None-Match"] = state["etag"]
+        if reusable and "last_modified" in state:
+            headers["If-Modified-Since"] = state["last_modified"]
+
+        timeout = aiohttp.ClientTimeout(total=float(self.bot.options["forum_timeout"]))
+        retries = int(self.bot.options["forum_retries"])
+        for attempt in range(retries + 1):
+            try:
+                async with self.forum_semaphore:
+                    async with self.portal.get(
+                        moodle.FORUM_URL.format(forum["id"]),
+                        headers=headers,
+                        timeout=timeout,
+                    ) as resp:
+                        if resp.status == 304:
+                            stats["not_modified"] += 1
+                            return state["announcements"]
+                        resp.raise_for_status()
+                        content = await resp.read()
+                        response_headers = resp.headers
+                break
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == retries:
+                    raise
+                await asyncio.sleep(2**attempt)
+
+        content_hash = hashlib.sha1(content).hexdigest()
+        if reusable and content_hash == state["hash"]:
+            stats["unchanged"] += 1
+            return state["announcements"]
+
+        announcements = await self.bot.executors.run_in_process(
+            moodle.parse_forum, content, since
+        )
+        stats["parsed"] += 1
+        state.clear()
+        state["hash"] = content_hash
+        state["announcements"] = announcements
+        state["since"] = since
+        if "ETag" in response_headers:
+            state["etag"] = response_headers["ETag"]
+        if "Last-Modified" in response_headers:
+            state["last_modified"] = response_headers["Last-Modified"]
+        return announcements
+
+    async def get_extra_details(self, _id):
+        if _id in self.details_cache:
+            details = self.details_cache.get(_id)
+        else:
+            try:
+                async with self.portal.get(moodle.DISCUSSION_URL.format(_id)) as resp:
+                    resp.raise_for_status()
+                    content = await resp.read()
+                details = await self.bot.executors.run_in_process(
+                    moodle.parse_discussion, content
+                )
+                details["date"] = details["date"].isoformat()
+            except (
+                aiohttp.ClientError,
+                asyncio.TimeoutError,
+                ValueError,
+                BrokenProcessPool,
+                PortalLoginError,
+            ) as e:
+                self.logger.warning(f"Failed to fetch discussion {_id}: {e!r}")
+                details = None
+            await self.details_cache.set(_id, details)
+
+        if details is not None:
+            return {
+                "description": details["description"],
+                "date": datetime.datetime.fromisoformat(details["date"]),
+            }
 
     async def news_embed(self, data):
         details = await self.get_extra_details(data["id"])
@@ -128,12 +243,36 @@ class Lancaster(BaseCog):
             title=data["title"],
             url=data["url"],
             colour=0xFF0000,
-            timestamp=details["date"],
-            description=details["description"],
+            timestamp=details["date"] if details else data["date"],
+            description=details["description"] if details else "",
         )
         embed.set_author(name=data["author"], icon_url=data["avatar"])
         return embed
 
+    @commands.is_owner()
+    @commands.command(hidden=True)
+    async def forums(self, ctx):
+        """Displays how often each forum was parsed or skipped."""
+        forum_data = await self.get_forums()
+
+        embed = discord.Embed(title="Forum Statistics", colour=0xFF0000)
+        if self.last_pass:
+            embed.description = (
+                f"Last Pass: `{self.last_pass['duration']:.2f}s`, "
+                f"`{self.last_pass['delivered']}` delivered, "
+                f"`{self.last_pass['failed']}` failed"
+            )
+        for forum in forum_data:
+            stats = self.forum_stats[forum["id"]]
+            embed.add_field(
+                name=forum["name"],
+                value=f"Parsed: `{stats['parsed']}`\n"
+                f"Not Modified: `{stats['not_modified']}`\n"
+                f"Unchanged: `{stats['unchanged']}`\n"
+                f"Interval: `{self.scheduler.intervals.get(forum['id'], 0) // 60}m`",
+            )
+        await ctx.send(embed=embed)
+
     @commands.command()
     async def cleardb(self, ctx):
         await self.moodle_posts.delete_records()
@@ -148,41 +287,211 @@ class Lancaster(BaseCog):
                 ctx.guild, "announcement_channel", channel_id
             )
             await ctx.send(f"{channel.mention} is now the announcement channel")
-            await self.check_for_announcements()
+            if await self.leader_election("announcements").acquire():
+                await self.check_for_announcements()
+            else:
+                # The leader only sends announcements above the marks,
+                # so the latest ones are sent to this guild from here.
+                await self.backfill_guild(ctx.guild, channel)
         else:
             await ctx.send("Announcement channel reset")
 
-    async def get_announcement_channel(self, guild):
-        channel_id = await self.bot.database.get_setting(guild, "announcement_channel")
-        if channel_id:
-            return guild.get_channel(int(channel_id))
-
-    async def check_for_announcements(self):
-        self.logger.info("Checking for new announcements.")
-        announcements = await self.get_news()
-        n = 0
-        for news in reversed(announcements[:5]):
-            for guild in self.bot.guilds:
-                exists = await self.moodle_posts.filter(
-                    where=DBFilter(guild_id=guild.id, post_id=news["id"])
+    async def get_announcement_channels(self, guilds):
+        """Get the announcement channel of every guild that has one,
+        with one query rather than one per guild."""
+        guilds = {guild.id: guild for guild in guilds}
+        if not guilds:
+            return {}
+        database = self.bot.database
+        records = await database.table(database.settings_table).filter(
+            where=DBFilter(key="announcement_channel", guild_id__any=list(guilds))
+        )
+        channels = {}
+        for record in records:
+            channel = guilds[record["guild_id"]].get_channel(int(record["value"]))
+            if channel:
+                channels[record["guild_id"]] = channel
+        return channels
+
+    async def check_for_announcements(self, forums=None):
+        """Deliver every announcement above its forum's high-water mark.
+        A forum without a mark yet delivers its 5 latest announcements,
+        checking every forum also delivers the 5 latest overall."""
+        async with self.pass_lock:
+            self.logger.info("Checking for new announcements.")
+            start = time.perf_counter()
+            # Another instance may have been the leader since the last pass.
+            for record in await self.forum_marks.filter(
+                where=DBFilter(scope=self.marks_scope)
+            ):
+                self.high_water[record["forum_id"]] = record["post_id"]
+            backfill = forums is None
+            announcements = await self.get_news(
+                forums, incremental=not backfill, scheduled=not backfill
+            )
+
+            by_forum = defaultdict(list)
+            for news in announcements:
+                by_forum[news["forum"]].append(news)
+            candidates = {}
+            for forum_id, posts in by_forum.items():
+                if forum_id in self.high_water:
+                    posts = [
+                        p for p in posts if int(p["id"]) > self.high_water[forum_id]
+                    ]
+                else:
+                    posts = posts[:5]
+                candidates.update({p["id"]: p for p in posts})
+            if backfill:
+                candidates.update({p["id"]: p for p in announcements[:5]})
+            latest = sorted(candidates.values(), key=lambda x: x["date"])
+
+            channels = await self.get_announcement_channels(self.bot.owned_guilds())
+
+            pending = defaultdict(dict)
+            for news in latest:
+                for guild_id in channels:
+                    pending[guild_id][news["id"]] = news
+            # The marks have already moved past deliveries that failed
+            # before, so they are retried on their own.
+            for (guild_id, post_id), (news, _) in self.failed_deliveries.items():
+                if guild_id in channels:
+                    pending[guild_id][post_id] = news
+
+            deliveries, results, new_posts = await self.send_pending(pending, channels)
+
+            self.record_failures(pending, deliveries, results)
+            await self.update_high_water(by_forum)
+
+            self.last_pass = {
+                "duration": time.perf_counter() - start,
+                "delivered": len(new_posts),
+                "failed": sum(len(p) for p in deliveries.values()) - len(new_posts),
+            }
+            if new_posts or self.last_pass["failed"]:
+                self.logger.info(
+                    f"Delivered {self.last_pass['delivered']} new announcements "
+                    f"({self.last_pass['failed']} failed) "
+                    f"in {self.last_pass['duration']:.2f}s."
                 )
-                if not exists:
-                    channel = await self.get_announcement_channel(guild)
-                    if channel:
-                        embed = await self.news_embed(news)
-                        await channel.send(embed=embed)
-                        await self.moodle_posts.new_record(
-                            guild_id=guild.id, post_id=news["id"]
-                        )
-                        n += 1
-        if n:
-            self.logger.info(f"Found {n} new announcements.")
-        else:
-            self.logger.info("No new announcements found.")
+            else:
+                self.logger.info("No new announcements found.")
 
-    @tasks.loop(minutes=10)
+    async def send_pending(self, pending, channels):
+        """Send each guild the pending announcements it hasn't been sent
+        yet, oldest first. Returns the deliveries, the IDs sent by each
+        and the posts to record as sent."""
+        posted = set()
+        if pending:
+            records = await self.moodle_posts.filter(
+                where=DBFilter(
+                    guild_id__any=list(pending),
+                    post_id__any=list({p for posts in pending.values() for p in posts}),
+                )
+            )
+            posted = {(r["guild_id"], r["post_id"]) for r in records}
+
+        embeds = {}
+        deliveries = defaultdict(list)
+        for guild_id, posts in pending.items():
+            for news in sorted(posts.values(), key=lambda x: x["date"]):
+                if (guild_id, news["id"]) not in posted:
+                    if news["id"] not in embeds:
+                        embeds[news["id"]] = await self.news_embed(news)
+                    deliveries[guild_id].append((news["id"], embeds[news["id"]]))
+
+        results = await asyncio.gather(
+            *[
+                self.deliver(channels[guild_id], posts)
+                for guild_id, posts in deliveries.items()
+            ]
+        )
+        new_posts = [
+            {"guild_id": guild_id, "post_id": post_id}
+            for guild_id, sent in zip(deliveries, results)
+            for post_id in sent
+        ]
+        await self.moodle_posts.upsert_many(("guild_id", "post_id"), new_posts)
+        return deliveries, results, new_posts
+
+    async def backfill_guild(self, guild, channel):
+        """Send a guild the 5 latest announcements without touching
+        the forums' marks, for when another instance is the leader."""
+        async with self.pass_lock:
+            announcements = await self.get_news(incremental=False)
+            pending = {guild.id: {news["id"]: news for news in announcements[:5]}}
+            await self.send_pending(pending, {guild.id: channel})
+
+    def record_failures(self, pending, deliveries, results):
+        """Keep the deliveries that failed to retry them next pass,
+        giving up on one once it has failed `delivery_attempts` times."""
+        attempts = int(self.bot.options["delivery_attempts"])
+        failed = {}
+        for (guild_id, posts), sent in zip(deliveries.items(), results):
+            for post_id, _ in posts:
+                if post_id in sent:
+                    continue
+                _, failures = self.failed_deliveries.get((guild_id, post_id), (None, 0))
+                if failures + 1 < attempts:
+                    news = pending[guild_id][post_id]
+                    failed[(guild_id, post_id)] = (news, failures + 1)
+                else:
+                    self.logger.warning(
+                        f"Giving up on announcement {post_id} for {guild_id} "
+                        f"after {attempts} attempts."
+                    )
+        self.failed_deliveries = failed
+
+    async def update_high_water(self, by_forum):
+        """Raise the high-water mark of each forum to its newest discussion,
+        deliveries that failed are retried by `record_failures` instead."""
+        marks = []
+        for forum_id, posts in by_forum.items():
+            previous = self.high_water.get(forum_id, 0)
+            mark = max([previous] + [int(p["id"]) for p in posts])
+            if mark != previous:
+                self.high_water[forum_id] = mark
+                marks.append(
+                    {"scope": self.marks_scope, "forum_id": forum_id, "post_id": mark}
+                )
+        await self.forum_marks.upsert_many(("scope", "forum_id"), marks)
+
+    async def deliver(self, channel, posts):
+        """Send announcements to a channel in order,
+        returns the IDs of the posts that were sent."""
+        sent = []
+        async with self.delivery_semaphore:
+            for post_id, embed in posts:
+                try:
+                    await channel.send(embed=embed)
+                except discord.HTTPException as e:
+                    self.logger.warning(
+                        f"Failed to send announcement {post_id} to {channel.id}: {e!r}"
+                    )
+                else:
+                    sent.append(post_id)
+        return sent
+
+    @tasks.loop(minutes=1)
+    @leader_only("announcements")
     async def check_for_announcements_task(self):
-        await self.check_for_announcements()
+        query_caller.set(f"{self.qualified_name}.check_for_announcements")
+        # An error would stop the loop for good while this process
+        # stays the leader, the forums are checked again next tick.
+        try:
+            forums = await self.get_forums()
+            due = set(self.scheduler.due([forum["id"] for forum in forums]))
+            if due:
+                await self.check_for_announcements(
+                    [forum for forum in forums if forum["id"] in due]
+                )
+        except Exception:
+            self.logger.exception("Failed to check for announcements.")
+
+    @check_for_announcements_task.after_loop
+    async def after_check_for_announcements(self):
+        # Let another instance take over once the loop has stopped.
+        await self.leader_election("announcements").release()
 
 
 def setup(bot):
@@ -0,0 +1,87 @@
+import datetime
+import json
+import time
+from collections import OrderedDict
+
+from .db.database import DBFilter
+from .db.fields import Json, Text, Timestamp
+
+
+class TTLCache:
+    """A size-bounded in-memory cache whose entries expire.
+
+    A value of None records a failed lookup, these entries
+    expire after `negative_ttl` seconds instead of `ttl`."""
+
+    def __init__(self, maxsize=1000, ttl=604800, negative_ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = OrderedDict()
+
+    def __contains__(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        if entry[0] < time.time():
+            del self.entries[key]
+            return False
+        return True
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key][1]
+
+    def _store(self, key, value, expires):
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    async def set(self, key, value):
+        ttl = self.ttl if value is not None else self.negative_ttl
+        self._store(key, value, time.time() + ttl)
+
+    async def load(self):
+        """Warm up the cache."""
+        pass
+
+
+class DatabaseCache(TTLCache):
+    """A TTLCache backed by a database table so that entries
+    survive restarts. Values must be JSON serialisable."""
+
+    def __init__(self, database, name, **kwargs):
+        super().__init__(**kwargs)
+        self.database = database
+        self.name = name
+        self.table = None
+
+    async def load(self):
+        self.table = await self.database.new_table(
+            self.name, (Text("key", unique=True), Json("value"), Timestamp("expires"))
+        )
+
+        now = datetime.datetime.utcnow()
+        await self.table.delete_records(where=DBFilter(expires__lt=now))
+        records = await self.table.all(
+            limit=self.maxsize, order_by="expires", desc=True
+        )
+        for record in reversed(records):
+            expires = record["expires"].replace(tzinfo=datetime.timezone.utc)
+            self._store(record["key"], json.loads(record["value"]), expires.timestamp())
+
+    async def set(self, key, value):
+        await super().set(key, value)
+        expires = self.entries[key][0]
+        await self.table.upsert_record(
+            ("key",),
+            key=key,
+            value=json.dumps(value),
+            expires=datetime.datetime.utcfromtimestamp(expires),
+        )
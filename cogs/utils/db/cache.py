@@ -0,0 +1,44 @@
+from collections import OrderedDict
+
+
+class SettingsCache:
+    """Keeps the settings of the most recently used guilds in memory.
+
+    Each entry holds every setting of a guild, so a guild that is
+    cached never needs a database round trip to read a setting."""
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.guilds = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, guild_id):
+        return guild_id in self.guilds
+
+    def __len__(self):
+        return len(self.guilds)
+
+    def get(self, guild_id, key):
+        """Get a setting of a cached guild."""
+        self.guilds.move_to_end(guild_id)
+        return self.guilds[guild_id].get(key)
+
+    def load(self, guild_id, settings):
+        """Cache every setting of a guild, evicting the least
+        recently used guild if the cache is full."""
+        self.guilds[guild_id] = settings
+        self.guilds.move_to_end(guild_id)
+        while len(self.guilds) > self.maxsize:
+            self.guilds.popitem(last=False)
+
+    def set(self, guild_id, key, value):
+        """Update a setting of a guild if it is cached."""
+        if guild_id in self.guilds:
+            if value is None:
+                self.guilds[guild_id].pop(key, None)
+            else:
+                self.guilds[guild_id][key] = value
+
+    def clear(self):
+        self.guilds.clear()
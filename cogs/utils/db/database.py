@@ -1,9 +1,128 @@
 import asyncio
+import contextvars
+import functools
+import itertools
+import json
+import logging
+import time
 import asyncpg
+from ..metrics import Histogram, format_labels, render_histogram
+from .cache import SettingsCache
 from .fields import *
-from collections import defaultdict
+from .locks import LeaderElection
+from .migrations import migrate
+from collections import OrderedDict, defaultdict
 from contextlib import asynccontextmanager
 
+query_caller = contextvars.ContextVar("query_caller", default="unknown")
+
+OPERATORS = {
+    "gt": ">",
+    "ge": ">=",
+    "lt": "<",
+    "le": "<=",
+    "ne": "!=",
+    "eq": "=",
+    "in": "IN",
+    "any": "= ANY",
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def split_field(field_name):
+    """Splits a filter keyword into its field and operator."""
+    field, _, operator = field_name.rpartition("__")
+    if field and operator in OPERATORS:
+        return field, operator
+    return field_name, "eq"
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_filter(shape, placeholders_from):
+    """Builds the WHERE clause for the shape of a DBFilter."""
+    conditions = defaultdict(list)
+    n = placeholders_from
+    for field_name, arity in shape:
+        field, operator = split_field(field_name)
+        if operator == "in":
+            array_sql = ", ".join([f"${x}" for x in range(n, n + arity)])
+            conditions[field].append(f"{field} IN ({array_sql})")
+            n += arity
+        elif arity == 0:
+            null_sql = "IS NOT NULL" if operator == "ne" else "IS NULL"
+            conditions[field].append(f"{field} {null_sql}")
+        elif operator == "any":
+            conditions[field].append(f"{field} = ANY(${n})")
+            n += 1
+        else:
+            conditions[field].append(f"{field} {OPERATORS[operator]} ${n}")
+            n += 1
+
+    filters = []
+    for field, conds in conditions.items():
+        if len(conds) > 1:
+            cond = "(" + " OR ".join(conds) + ")"
+        else:
+            cond = conds[0]
+        filters.append(cond)
+
+    return "WHERE " + " AND ".join(filters)
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_select(table, where_sql, order_by, desc, limit):
+    limit_sql = f"LIMIT {limit}" if limit is not None else ""
+    order_by_sql = (
+        f"ORDER BY {order_by}" + (" DESC" if desc else "")
+        if order_by is not None
+        else ""
+    )
+    return f"SELECT * FROM {table} {where_sql} {order_by_sql} {limit_sql};"
+
+
+def compile_conflict(fields, conflict):
+    conflict_sql = ", ".join(conflict)
+    updates = [f"{f}=EXCLUDED.{f}" for f in fields if f not in conflict]
+    action_sql = "DO UPDATE SET " + ", ".join(updates) if updates else "DO NOTHING"
+    return f" ON CONFLICT ({conflict_sql}) {action_sql}"
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_insert(table, fields, conflict=None, returning=None):
+    fields_sql = ", ".join(fields)
+    values_sql = ", ".join([f"${n}" for n, _ in enumerate(fields, start=1)])
+    sql = f"INSERT INTO {table} ({fields_sql}) VALUES ({values_sql})"
+    if conflict is not None:
+        sql += compile_conflict(fields, conflict)
+    if returning is not None:
+        sql += f" RETURNING {returning}"
+    return sql + ";"
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_upsert_many(table, fields, types, conflict):
+    """Builds an upsert of one array per field, unnested into rows."""
+    fields_sql = ", ".join(fields)
+    arrays_sql = ", ".join([f"${n}::{t}[]" for n, t in enumerate(types, start=1)])
+    return (
+        f"INSERT INTO {table} ({fields_sql}) SELECT * FROM unnest({arrays_sql})"
+        + compile_conflict(fields, conflict)
+        + ";"
+    )
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_update(table, fields, where_sql):
+    updates_sql = ", ".join(
+        [f"{field}=${n}" for n, field in enumerate(fields, start=1)]
+    )
+    return f"UPDATE {table} SET {updates_sql} {where_sql};"
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_delete(table, where_sql):
+    return f"DELETE FROM {table} {where_sql};"
+
 
 class DBFilter:
     """Specifies how to filter items in a database query."""
@@ -11,62 +130,29 @@ class DBFilter:
     def __init__(self, **kwargs):
         self.filter_kwargs = kwargs
 
-    def sql(self, placeholders_from=1):
-        conditions = defaultdict(list)
-        values = list(self.filter_kwargs.values())
-        removes = []
-
-        for num, field_name in enumerate(
-            self.filter_kwargs.keys(), start=placeholders_from
-        ):
-            n = num - len(removes)
-            i = num - placeholders_from
-            if field_name.endswith("__in"):
-                array_sql = (
-                    "("
-                    + ", ".join([f"${x}" for x in range(n, n + len(values[i]))])
-                    + ")"
-                )
-                array = values.pop(i)
-                for item in array[::-1]:
-                    values.insert(i, item)
-                conditions[field_name[:-4]].append(f"{field_name[:-4]} IN {array_sql}")
-            elif field_name.endswith("__gt"):
-                conditions[field_name[:-4]].append(f"{field_name[:-4:]} > ${n}")
-            elif field_name.endswith("__ge"):
-                conditions[field_name[:-4]].append(f"{field_name[:-4:]} >= ${n}")
-            elif field_name.endswith("__lt"):
-                conditions[field_name[:-4]].append(f"{field_name[:-4:]} < ${n}")
-            elif field_name.endswith("__le"):
-                conditions[field_name[:-4]].append(f"{field_name[:-4:]} <= ${n}")
-            elif field_name.endswith("__lt"):
-                conditions[field_name[:-4]].append(f"{field_name[:-4:]} < ${n}")
-            elif field_name.endswith("__ne"):
-                if values[i] is None:
-                    conditions[field_name[:-4]].append(
-                        f"{field_name[:-4:]} IS NOT NULL"
-                    )
-                    removes.append(i)
-                else:
-                    conditions[field_name[:-4]].append(f"{field_name[:-4:]} != ${n}")
+    def shape(self):
+        """The parts of the filter that change its SQL: the keywords,
+        the length of `__in` lists and which values are None."""
+        shape = []
+        for field_name, value in self.filter_kwargs.items():
+            field, operator = split_field(field_name)
+            if operator == "in":
+                shape.append((field_name, len(value)))
+            elif value is None and operator in ("eq", "ne"):
+                shape.append((field_name, 0))
             else:
-                if values[i] is None:
-                    conditions[field_name].append(f"{field_name} IS NULL")
-                    removes.append(i)
-                else:
-                    conditions[field_name].append(f"{field_name} = ${n}")
-
-        filters = []
-        for field, conds in conditions.items():
-            if len(conds) > 1:
-                cond = "(" + " OR ".join(conds) + ")"
-            else:
-                cond = conds[0]
-            filters.append(cond)
-
-        values = [v for n, v in enumerate(values) if n not in removes]
+                shape.append((field_name, 1))
+        return tuple(shape)
 
-        return "WHERE " + " AND ".join(filters), values
+    def sql(self, placeholders_from=1):
+        values = []
+        for field_name, value in self.filter_kwargs.items():
+            field, operator = split_field(field_name)
+            if operator == "in":
+                values.extend(value)
+            elif value is not None or operator not in ("eq", "ne"):
+                values.append(value)
+        return compile_filter(self.shape(), placeholders_from), values
 
 
 class DBQuery:
@@ -79,82 +165,139 @@ class DBQuery:
 
     async def all(self, limit=None, order_by=None, desc=False):
         """Get all records in the table."""
-        limit_sql = f"LIMIT {limit}" if limit is not None else ""
-        order_by_sql = (
-            f"ORDER BY {order_by}" + (" DESC" if desc else "")
-            if order_by is not None
-            else ""
+        return await self.database.fetch(
+            compile_select(self.name, "", order_by, desc, limit)
         )
-        async with self.database.connection() as conn:
-            return await conn.fetch(
-                f"SELECT * FROM {self.name} {order_by_sql} {limit_sql};"
-            )
 
     async def filter(self, where: DBFilter, limit=None, order_by=None, desc=False):
         """Get records in the table based on a filter."""
-        limit_sql = f"LIMIT {limit}" if limit is not None else ""
-        order_by_sql = (
-            f"ORDER BY {order_by}" + (" DESC" if desc else "")
-            if order_by is not None
-            else ""
+        where_sql, where_values = where.sql()
+        return await self.database.fetch(
+            compile_select(self.name, where_sql, order_by, desc, limit),
+            *where_values,
         )
+
+    async def iter_all(self, order_by=None, desc=False, prefetch=100):
+        """Iterate over all records in the table using a server-side
+        cursor, fetching `prefetch` records at a time.
+        Note: a connection is held until the iteration finishes."""
+        async for record in self.database.iterate(
+            compile_select(self.name, "", order_by, desc, None), prefetch=prefetch
+        ):
+            yield record
+
+    async def iter_filter(
+        self, where: DBFilter, order_by=None, desc=False, prefetch=100
+    ):
+        """Iterate over records in the table based on a filter,
+        see `iter_all`."""
         where_sql, where_values = where.sql()
-        async with self.database.connection() as conn:
-            return await conn.fetch(
-                f"SELECT * FROM {self.name} {where_sql} {order_by_sql} {limit_sql};",
-                *where_values,
-            )
+        async for record in self.database.iterate(
+            compile_select(self.name, where_sql, order_by, desc, None),
+            *where_values,
+            prefetch=prefetch,
+        ):
+            yield record
+
+    async def paginate(self, where: DBFilter = None, key="id", page_size=1000):
+        """Iterate over pages of records ordered by `key`. Each page is
+        fetched with keyset pagination, so later pages are as fast to
+        fetch as the first and no connection is held between pages.
+        Note: `key` must be unique and must not be used in `where`."""
+        last = None
+        while True:
+            filter_kwargs = dict(where.filter_kwargs) if where else {}
+            if last is not None:
+                filter_kwargs[f"{key}__gt"] = last
+            if filter_kwargs:
+                page = await self.filter(
+                    DBFilter(**filter_kwargs), limit=page_size, order_by=key
+                )
+            else:
+                page = await self.all(limit=page_size, order_by=key)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            last = page[-1][key]
 
     async def new_record(self, **kwargs):
         """Create a new record in a database."""
-        fields_sql = ", ".join(kwargs.keys())
-        values_sql = ", ".join([f"${n}" for n, _ in enumerate(kwargs, start=1)])
-        async with self.database.connection() as conn:
-            return await conn.execute(
-                f"INSERT INTO {self.name} ({fields_sql}) VALUES ({values_sql});",
-                *kwargs.values(),
-            )
+        return await self.database.execute(
+            compile_insert(self.name, tuple(kwargs)), *kwargs.values()
+        )
 
     async def new_record_with_id(self, **kwargs):
         """Create a new record in a database and return the 'id' value.
         Note: this only works on tables with a SerialIdentifier field."""
-        fields_sql = ", ".join(kwargs.keys())
-        values_sql = ", ".join([f"${n}" for n, _ in enumerate(kwargs, start=1)])
-        async with self.database.connection() as conn:
-            return await conn.fetchval(
-                f"INSERT INTO {self.name} ({fields_sql}) VALUES ({values_sql}) RETURNING id;",
-                *kwargs.values(),
-            )
+        return await self.database.fetchval(
+            compile_insert(self.name, tuple(kwargs), returning="id"),
+            *kwargs.values(),
+        )
+
+    async def new_records(self, records):
+        """Create many new records in a database table at once using COPY,
+        returns the number of records created.
+        Every record must be a dict with the same keys."""
+        records = iter(records)
+        first = next(records, None)
+        if first is None:
+            return 0
+        fields = tuple(first.keys())
+        rows = itertools.chain([first], records)
+        return await self.database.copy_records(
+            self.name, fields, (tuple(r[f] for f in fields) for r in rows)
+        )
+
+    async def upsert_record(self, conflict, **kwargs):
+        """Create a new record, or update the existing record
+        that has the same values for the `conflict` fields.
+        Note: the conflict fields must have a unique index."""
+        return await self.database.execute(
+            compile_insert(self.name, tuple(kwargs), conflict=tuple(conflict)),
+            *kwargs.values(),
+        )
+
+    async def upsert_many(self, conflict, records):
+        """Create or update many records in one statement, see
+        `upsert_record`, returns the number of records created or
+        updated. Records skipped because nothing needed updating
+        (DO NOTHING) aren't counted, if several records have the
+        same values for the `conflict` fields only the last is used.
+        Every record must be a dict with the same keys."""
+        conflict = tuple(conflict)
+        records = list({tuple(r[f] for f in conflict): r for r in records}.values())
+        if not records:
+            return 0
+        fields = tuple(records[0].keys())
+        types = await self.database.column_types(self.name)
+        status = await self.database.execute(
+            compile_upsert_many(
+                self.name, fields, tuple(types[f] for f in fields), conflict
+            ),
+            *[[r[f] for r in records] for f in fields],
+        )
+        return int(status.split()[-1])
 
     async def update_records(self, where: DBFilter = None, **kwargs):
         """Update records in a database table."""
-        updates_sql = ", ".join(
-            [f"{field}=${n}" for n, field in enumerate(kwargs.keys(), start=1)]
+        where_sql, where_values = "", []
+        if where:
+            where_sql, where_values = where.sql(placeholders_from=len(kwargs) + 1)
+        return await self.database.execute(
+            compile_update(self.name, tuple(kwargs), where_sql),
+            *kwargs.values(),
+            *where_values,
         )
 
-        async with self.database.connection() as conn:
-            if where:
-                where_sql, where_values = where.sql(placeholders_from=len(kwargs) + 1)
-                return await conn.execute(
-                    f"UPDATE {self.name} SET {updates_sql} {where_sql};",
-                    *kwargs.values(),
-                    *where_values,
-                )
-            else:
-                return await conn.execute(
-                    f"UPDATE {self.name} SET {updates_sql};", *kwargs.values()
-                )
-
     async def delete_records(self, *, where: DBFilter = None):
         """Delete records in a database table."""
-        async with self.database.connection() as conn:
-            if where:
-                where_sql, where_values = where.sql()
-                return await conn.execute(
-                    f"DELETE FROM {self.name} {where_sql};", *where_values
-                )
-            else:
-                return await conn.execute(f"DELETE FROM {self.name};")
+        where_sql, where_values = "", []
+        if where:
+            where_sql, where_values = where.sql()
+        return await self.database.execute(
+            compile_delete(self.name, where_sql), *where_values
+        )
 
 
 class Database:
@@ -163,56 +306,336 @@ class Database:
 
     settings_table = "server_setting"
 
-    def __init__(self, url, ssl=False):
+    def __init__(
+        self,
+        url,
+        ssl=False,
+        *,
+        min_size=2,
+        max_size=10,
+        timeout=10,
+        statement_cache_size=100,
+        settings_cache_size=1000,
+        slow_query_threshold=0.25,
+    ):
         self.url = url + ("&sslmode=require" if ssl else "")
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.statement_cache_size = statement_cache_size
+        self.pool = None
+        self.settings = SettingsCache(maxsize=settings_cache_size)
+        self.prefixes = {}
+        self.tables = {}
+        self.columns = {}
+        self.bootstrapped = False
+        self.queries = OrderedDict()
+        self.elections = {}
+        self.slow_query_threshold = slow_query_threshold
+        self.query_latency = defaultdict(Histogram)
+        self.query_rows = defaultdict(int)
+        self.acquire_wait = Histogram()
+        self.slow_queries = 0
+        self.logger = logging.getLogger(__name__)
+        self._connect_lock = asyncio.Lock()
 
     async def connect(self):
-        await self.new_table(
-            self.settings_table,
-            (
-                BigInteger("guild_id"),
-                Text("key"),
-                Text("value"),
-            ),
-        )
+        """Create the pool and bootstrap the schema and settings. This
+        is only done once per process, later calls (e.g. from every
+        gateway reconnect) return straight away."""
+        if self.bootstrapped:
+            return
+        async with self._connect_lock:
+            if self.bootstrapped:
+                return
+            start = time.perf_counter()
+            if self.pool is None:
+                self.pool = await asyncpg.create_pool(
+                    self.url,
+                    min_size=self.min_size,
+                    max_size=self.max_size,
+                    statement_cache_size=self.statement_cache_size,
+                )
+            await migrate(self)
+            await self.new_table(
+                self.settings_table,
+                (
+                    BigInteger("guild_id"),
+                    Text("key"),
+                    Text("value"),
+                    Index("guild_id", "key", unique=True),
+                ),
+            )
+            await self.load_settings()
+            self.bootstrapped = True
+            self.logger.info(f"Database ready in {time.perf_counter() - start:.2f}s.")
+
+    async def load_settings(self):
+        """Load the settings of every guild into the settings cache.
+
+        Prefixes are also kept in `prefixes`, which is never evicted,
+        since the prefix of every guild is needed on every message."""
+        guilds = defaultdict(dict)
+        prefixes = {}
+        async for record in self.table(self.settings_table).iter_all():
+            guilds[record["guild_id"]][record["key"]] = record["value"]
+            if record["key"] == "prefix":
+                prefixes[record["guild_id"]] = record["value"]
+        self.prefixes = prefixes
+        self.settings.clear()
+        for guild_id, settings in guilds.items():
+            self.settings.load(guild_id, settings)
 
     async def get_setting(self, guild, key):
-        records = await self.table(self.settings_table).filter(
-            where=DBFilter(guild_id=guild.id, key=key)
-        )
-        if records:
-            return records[0]["value"]
+        if guild.id in self.settings:
+            self.settings.hits += 1
+        else:
+            self.settings.misses += 1
+            records = await self.table(self.settings_table).filter(
+                where=DBFilter(guild_id=guild.id)
+            )
+            self.settings.load(guild.id, {r["key"]: r["value"] for r in records})
+        return self.settings.get(guild.id, key)
 
     async def set_setting(self, guild, key, value):
-        await self.table(self.settings_table).delete_records(
-            where=DBFilter(guild_id=guild.id, key=str(key))
-        )
-        if value is not None:
-            await self.table(self.settings_table).new_record(
-                guild_id=guild.id, key=str(key), value=str(value)
+        if value is None:
+            await self.table(self.settings_table).delete_records(
+                where=DBFilter(guild_id=guild.id, key=str(key))
+            )
+        else:
+            await self.table(self.settings_table).upsert_record(
+                ("guild_id", "key"), guild_id=guild.id, key=str(key), value=str(value)
             )
+        self.settings.set(guild.id, str(key), None if value is None else str(value))
+        if str(key) == "prefix":
+            if value is None:
+                self.prefixes.pop(guild.id, None)
+            else:
+                self.prefixes[guild.id] = str(value)
 
     async def new_table(self, name, fields):
+        """Create a table if it doesn't exist yet, then add any
+        fields and indexes that the table is missing. The DDL is
+        skipped if this process already created the same table,
+        e.g. when a cog is reloaded."""
         fields = [SerialIdentifier()] + list(fields)
-        fields = ", ".join([f'"{f.name}" {f.datatype}' for f in fields])
-        async with self.connection() as conn:
-            await conn.execute(f"CREATE TABLE IF NOT EXISTS {name} ({fields});")
+        columns = [f for f in fields if isinstance(f, Field)]
+        indexes = [f for f in fields if isinstance(f, Index)]
+        indexes += [
+            Index(f.name, unique=f.unique) for f in columns if f.unique or f.index
+        ]
+        schema = (
+            tuple((f.name, f.datatype) for f in columns),
+            tuple((i.field_names, i.unique) for i in indexes),
+        )
+        if self.tables.get(name) == schema:
+            return self.table(name)
+
+        columns_sql = ", ".join([f'"{f.name}" {f.datatype}' for f in columns])
+        await self.execute(f"CREATE TABLE IF NOT EXISTS {name} ({columns_sql});")
+        # ALTER TABLE locks the table even when it changes nothing,
+        # which would stall every other instance's queries on it.
+        self.columns.pop(name, None)
+        existing = await self.column_types(name)
+        add_columns_sql = ", ".join(
+            [
+                f'ADD COLUMN IF NOT EXISTS "{f.name}" {f.datatype}'
+                for f in columns[1:]
+                if f.name not in existing
+            ]
+        )
+        if add_columns_sql:
+            await self.execute(f"ALTER TABLE {name} {add_columns_sql};")
+        for index in indexes:
+            await self.create_index(name, index.field_names, unique=index.unique)
+        self.tables[name] = schema
+        self.columns.pop(name, None)
         return self.table(name)
 
+    async def create_index(self, table, columns, unique=False):
+        """Create an index on a table if it doesn't exist yet."""
+        name = f"{table}_{'_'.join(columns)}_{'key' if unique else 'idx'}"
+        if await self.fetchval("SELECT to_regclass($1);", name):
+            return
+        await self.execute(
+            f"CREATE {'UNIQUE ' if unique else ''}INDEX IF NOT EXISTS "
+            f"{name} ON {table} ({', '.join(columns)});"
+        )
+
+    async def column_types(self, table):
+        """Get the SQL type of every column in a table."""
+        if table not in self.columns:
+            records = await self.fetch(
+                "SELECT attname, format_type(atttypid, atttypmod) AS type "
+                "FROM pg_attribute WHERE attrelid = $1::regclass "
+                "AND attnum > 0 AND NOT attisdropped;",
+                table,
+            )
+            self.columns[table] = {r["attname"]: r["type"] for r in records}
+        return self.columns[table]
+
+    def track_query(self, sql, args):
+        """Remember a filtered query so its plan can be checked
+        by `find_sequential_scans`."""
+        if " WHERE " in sql:
+            self.queries[sql] = args
+            self.queries.move_to_end(sql)
+            if len(self.queries) > 256:
+                self.queries.popitem(last=False)
+
+    async def find_sequential_scans(self):
+        """EXPLAIN every tracked query with sequential scans disabled,
+        returns the (table, sql) of every query that still needs one
+        because no index can answer it."""
+        results = []
+        async with self.connection() as conn:
+            for sql, args in list(self.queries.items()):
+                async with conn.transaction():
+                    await self._run(
+                        "execute", "SET LOCAL enable_seqscan = off;", conn=conn
+                    )
+                    plan = await self._run(
+                        "fetchval", f"EXPLAIN (FORMAT JSON) {sql}", *args, conn=conn
+                    )
+                nodes = [json.loads(plan)[0]["Plan"]]
+                while nodes:
+                    node = nodes.pop()
+                    if node["Node Type"] == "Seq Scan":
+                        results.append((node["Relation Name"], sql))
+                    nodes.extend(node.get("Plans", []))
+        return results
+
+    def record_query(self, sql, duration, rows):
+        caller = query_caller.get()
+        self.query_latency[(sql, caller)].observe(duration)
+        self.query_rows[(sql, caller)] += rows
+        if duration >= self.slow_query_threshold:
+            self.slow_queries += 1
+            self.logger.warning(
+                f"Slow query from {caller} took {duration * 1000:.0f}ms: {sql}"
+            )
+
+    def render_metrics(self):
+        """Renders the query metrics in the Prometheus text format."""
+        lines = ["# TYPE database_query_seconds histogram"]
+        for (sql, caller), histogram in self.query_latency.items():
+            lines += render_histogram(
+                "database_query_seconds", histogram, {"query": sql, "caller": caller}
+            )
+        lines.append("# TYPE database_query_rows_total counter")
+        for (sql, caller), rows in self.query_rows.items():
+            lines.append(
+                f"database_query_rows_total{format_labels({'query': sql, 'caller': caller})} {rows}"
+            )
+        lines.append("# TYPE database_acquire_seconds histogram")
+        lines += render_histogram("database_acquire_seconds", self.acquire_wait)
+        lines.append("# TYPE database_slow_queries_total counter")
+        lines.append(f"database_slow_queries_total {self.slow_queries}")
+        return lines
+
+    async def _run(self, method, sql, *args, conn=None):
+        """Run a statement and record its latency and rows, on `conn`
+        if given, otherwise on a connection from the pool."""
+        if conn is None:
+            async with self.connection() as conn:
+                return await self._run(method, sql, *args, conn=conn)
+
+        start = time.perf_counter()
+        result = await getattr(conn, method)(sql, *args)
+        duration = time.perf_counter() - start
+
+        if method == "fetch":
+            rows = len(result)
+        elif method == "executemany":
+            rows = len(args[0])
+        elif method == "execute":
+            count = result.split()[-1]
+            rows = int(count) if count.isdigit() else 0
+        else:
+            rows = int(result is not None)
+        self.record_query(sql, duration, rows)
+        return result
+
+    async def fetch(self, sql, *args, conn=None):
+        self.track_query(sql, args)
+        return await self._run("fetch", sql, *args, conn=conn)
+
+    async def fetchval(self, sql, *args, conn=None):
+        self.track_query(sql, args)
+        return await self._run("fetchval", sql, *args, conn=conn)
+
+    async def execute(self, sql, *args, conn=None):
+        self.track_query(sql, args)
+        return await self._run("execute", sql, *args, conn=conn)
+
+    async def executemany(self, sql, args, conn=None):
+        return await self._run("executemany", sql, args, conn=conn)
+
+    async def iterate(self, sql, *args, prefetch=100):
+        """Iterate over the records of a query with a server-side cursor,
+        fetching `prefetch` records at a time. The time spent fetching
+        is recorded as one query, the time spent by the caller isn't.
+        Note: a connection is held until the iteration finishes."""
+        self.track_query(sql, args)
+        duration = rows = 0
+        async with self.connection() as conn:
+            async with conn.transaction():
+                try:
+                    start = time.perf_counter()
+                    cursor = await conn.cursor(sql, *args)
+                    while True:
+                        records = await cursor.fetch(prefetch)
+                        duration += time.perf_counter() - start
+                        rows += len(records)
+                        for record in records:
+                            yield record
+                        if len(records) < prefetch:
+                            break
+                        start = time.perf_counter()
+                finally:
+                    self.record_query(sql, duration, rows)
+
+    async def copy_records(self, table, columns, records):
+        """Copy records into a table with COPY,
+        returns the number of records copied."""
+        sql = f"COPY {table} ({', '.join(columns)}) FROM STDIN;"
+        async with self.connection() as conn:
+            start = time.perf_counter()
+            status = await conn.copy_records_to_table(
+                table, records=records, columns=columns
+            )
+            duration = time.perf_counter() - start
+        rows = int(status.split()[-1])
+        self.record_query(sql, duration, rows)
+        return rows
+
+    def leader_election(self, name):
+        """Get the leader election for `name`, see `LeaderElection`."""
+        if name not in self.elections:
+            self.elections[name] = LeaderElection(self, name)
+        return self.elections[name]
+
+    async def close(self):
+        """Close every connection in the pool."""
+        for election in self.elections.values():
+            await election.release()
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+        self.bootstrapped = False
+
     @asynccontextmanager
     async def connection(self):
-        conn = await asyncpg.connect(self.url)
-        try:
+        start = time.perf_counter()
+        async with self.pool.acquire(timeout=self.timeout) as conn:
+            self.acquire_wait.observe(time.perf_counter() - start)
             yield conn
-        finally:
-            await conn.close()
 
     async def execute_sql(self, sql_query):
         """Execute an SQL query manually."""
         if not sql_query.endswith(";"):
             sql_query += ";"
-        async with self.connection() as conn:
-            return await conn.fetch(sql_query)
+        return await self._run("fetch", sql_query)
 
     def table(self, name):
         return DBQuery(self, name)
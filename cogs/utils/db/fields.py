@@ -5,9 +5,11 @@ class Field:
 
     _datatype = None
 
-    def __init__(self, field_name, *, default=None):
+    def __init__(self, field_name, *, default=None, unique=False, index=False):
         self.name = field_name
         self.default = default
+        self.unique = unique
+        self.index = index
         self.datatype_options = {}
 
     @property
@@ -18,6 +20,14 @@ class Field:
         return dt
 
 
+class Index:
+    """Represents an index on one or more fields in a database table"""
+
+    def __init__(self, *field_names, unique=False):
+        self.field_names = field_names
+        self.unique = unique
+
+
 class SerialIdentifier(Field):
     _datatype = "SERIAL PRIMARY KEY"
 
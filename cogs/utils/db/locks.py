@@ -0,0 +1,69 @@
+import asyncio
+import hashlib
+import logging
+
+import asyncpg
+
+
+class LeaderElection:
+    """Elects a single leader among every process using the same
+    database with a Postgres advisory lock.
+
+    The lock is held on a dedicated connection, so if the leader dies
+    its connection closes, the lock is released and the next process
+    to call `acquire` takes over."""
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.key = int.from_bytes(
+            hashlib.sha1(name.encode()).digest()[:8], "big", signed=True
+        )
+        self.connection = None
+        self.leader = False
+        self.logger = logging.getLogger(__name__)
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Try to become the leader, returns whether this process
+        is the leader. The leader's connection is checked each time
+        so that a lost lock is noticed."""
+        async with self._lock:
+            try:
+                if self.connection is None or self.connection.is_closed():
+                    self.leader = False
+                    self.connection = await asyncpg.connect(self.database.url)
+                if self.leader:
+                    await self.database.fetchval("SELECT 1;", conn=self.connection)
+                else:
+                    self.leader = await self.database.fetchval(
+                        "SELECT pg_try_advisory_lock($1);",
+                        self.key,
+                        conn=self.connection,
+                    )
+                    if self.leader:
+                        self.logger.info(f"Became the leader for {self.name}.")
+            except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError) as e:
+                self.logger.warning(f"Lost the connection for {self.name}: {e!r}")
+                await self._close()
+            return self.leader
+
+    async def release(self):
+        """Step down as the leader and close the connection."""
+        async with self._lock:
+            if self.leader and self.connection is not None:
+                try:
+                    await self.database.execute(
+                        "SELECT pg_advisory_unlock($1);",
+                        self.key,
+                        conn=self.connection,
+                    )
+                except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError):
+                    pass
+            await self._close()
+
+    async def _close(self):
+        self.leader = False
+        if self.connection is not None:
+            self.connection.terminate()
+            self.connection = None
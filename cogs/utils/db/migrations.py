@@ -0,0 +1,89 @@
+from .fields import *
+
+MIGRATIONS_TABLE = "schema_migration"
+
+
+class Migration:
+    """A one-off change to the database, migrations are applied
+    once each in order of their version.
+
+    If `table` is given the migration is only run when that table
+    exists, a table created after the migration already has the
+    new schema."""
+
+    def __init__(self, version, description, *statements, table=None):
+        self.version = version
+        self.description = description
+        self.statements = statements
+        self.table = table
+
+
+def delete_duplicates(table, *columns):
+    """SQL that deletes all but the newest row of every group
+    of rows sharing the same values for `columns`."""
+    matches_sql = " AND ".join([f"a.{c} = b.{c}" for c in columns])
+    return f"DELETE FROM {table} a USING {table} b WHERE a.id < b.id AND {matches_sql};"
+
+
+MIGRATIONS = (
+    Migration(
+        1,
+        "Remove duplicate server settings before indexing (guild_id, key)",
+        delete_duplicates("server_setting", "guild_id", "key"),
+        table="server_setting",
+    ),
+    Migration(
+        2,
+        "Remove duplicate posted announcements before indexing (guild_id, post_id)",
+        delete_duplicates("demographics_roles", "guild_id", "post_id"),
+        table="demographics_roles",
+    ),
+)
+
+
+async def migrate(database, migrations=MIGRATIONS):
+    """Apply every migration that hasn't been applied yet,
+    returns the versions that were applied."""
+    table = await database.new_table(
+        MIGRATIONS_TABLE,
+        (
+            Integer("version", unique=True),
+            Text("description"),
+            Timestamp("applied", default="now()"),
+        ),
+    )
+    done = {r["version"] for r in await table.all()}
+    applied = []
+
+    for migration in sorted(migrations, key=lambda m: m.version):
+        if migration.version in done:
+            continue
+        async with database.connection() as conn:
+            async with conn.transaction():
+                # Another instance may be applying the same migration.
+                await database.execute(
+                    "SELECT pg_advisory_xact_lock(hashtext($1));",
+                    MIGRATIONS_TABLE,
+                    conn=conn,
+                )
+                if await database.fetchval(
+                    f"SELECT 1 FROM {MIGRATIONS_TABLE} WHERE version = $1;",
+                    migration.version,
+                    conn=conn,
+                ):
+                    continue
+                if migration.table is None or await database.fetchval(
+                    "SELECT to_regclass($1);", migration.table, conn=conn
+                ):
+                    for statement in migration.statements:
+                        # Not tracked, a one-off statement isn't worth indexing for.
+                        await database._run("execute", statement, conn=conn)
+                await database.execute(
+                    f"INSERT INTO {MIGRATIONS_TABLE} (version, description) "
+                    "VALUES ($1, $2);",
+                    migration.version,
+                    migration.description,
+                    conn=conn,
+                )
+        applied.append(migration.version)
+    return applied
@@ -0,0 +1,53 @@
+import asyncio
+import concurrent.futures
+import functools
+
+
+class Executors:
+    """Runs blocking functions away from the event loop, I/O in
+    a thread pool and CPU-heavy work in a process pool."""
+
+    def __init__(self, threads=4, processes=2):
+        self.thread_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="executor"
+        )
+        self.processes = processes
+        self.process_pool = None
+        if processes > 0:
+            self.process_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=processes
+            )
+
+    async def run_in_thread(self, func, *args, **kwargs):
+        """Run a blocking I/O function in the thread pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.thread_pool, functools.partial(func, *args, **kwargs)
+        )
+
+    async def run_in_process(self, func, *args, **kwargs):
+        """Run a CPU-heavy function in the process pool, the function and
+        its arguments must be picklable. Falls back to the thread pool
+        when there are no worker processes.
+
+        If a worker process dies the pool is broken for good, so it is
+        replaced before BrokenProcessPool is raised to the caller."""
+        loop = asyncio.get_running_loop()
+        pool = self.process_pool
+        try:
+            return await loop.run_in_executor(
+                pool or self.thread_pool,
+                functools.partial(func, *args, **kwargs),
+            )
+        except concurrent.futures.process.BrokenProcessPool:
+            if self.process_pool is pool:
+                self.process_pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.processes
+                )
+                pool.shutdown(wait=False)
+            raise
+
+    def shutdown(self):
+        self.thread_pool.shutdown(wait=False)
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=False)
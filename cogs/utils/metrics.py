@@ -0,0 +1,162 @@
+import asyncio
+import bisect
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Counts observations in buckets, the most recent observations
+    are also kept to calculate percentiles."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, window=1000):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def percentile(self, percent):
+        """Get a percentile of the recent observations."""
+        if not self.recent:
+            return 0
+        values = sorted(self.recent)
+        index = min(len(values) - 1, int(len(values) * percent / 100))
+        return values[index]
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = {
+        k: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for k, v in labels.items()
+    }
+    return "{" + ",".join([f'{k}="{v}"' for k, v in escaped.items()]) + "}"
+
+
+def render_histogram(name, histogram, labels=None):
+    """Renders a histogram in the Prometheus text format."""
+    labels = labels or {}
+    lines = []
+    cumulative = 0
+    for bucket, count in zip(histogram.buckets, histogram.bucket_counts):
+        cumulative += count
+        lines.append(
+            f"{name}_bucket{format_labels({**labels, 'le': bucket})} {cumulative}"
+        )
+    lines.append(
+        f"{name}_bucket{format_labels({**labels, 'le': '+Inf'})} {histogram.count}"
+    )
+    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+    lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+    return lines
+
+
+class MetricsServer:
+    """Serves metrics in the Prometheus text format on /metrics.
+
+    Each collector is a function that returns a list of lines."""
+
+    def __init__(self, port, host="127.0.0.1"):
+        self.port = port
+        self.host = host
+        self.collectors = []
+        self.runner = None
+        self.logger = logging.getLogger(__name__)
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    async def metrics(self, request):
+        lines = []
+        for collector in self.collectors:
+            lines.extend(collector())
+        return web.Response(text="\n".join(lines) + "\n")
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.metrics)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        self.logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes up from a sleep.
+
+    A watchdog thread logs the stack of the event loop thread whenever
+    the loop has been blocked for longer than `threshold` seconds."""
+
+    def __init__(self, interval=0.5, threshold=0.25):
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = Histogram()
+        self.blocked = 0
+        self.task = None
+        self.logger = logging.getLogger(__name__)
+        self._heartbeat = time.monotonic()
+        self._loop_thread = None
+        self._stopped = threading.Event()
+
+    def start(self, loop):
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self.task = loop.create_task(self.run())
+        threading.Thread(target=self.watch, daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self._heartbeat = time.monotonic()
+            self.lag.observe(max(0, self._heartbeat - start - self.interval))
+
+    def watch(self):
+        reported = None
+        while not self._stopped.wait(self.threshold / 2):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled > self.threshold and reported != heartbeat:
+                reported = heartbeat
+                self.blocked += 1
+                frame = sys._current_frames().get(self._loop_thread)
+                stack = "".join(traceback.format_stack(frame)) if frame else ""
+                self.logger.warning(
+                    f"The event loop has been blocked for {stalled:.2f}s:\n{stack}"
+                )
@@ -0,0 +1,107 @@
+import datetime
+import re
+
+# lxml and dateutil are imported by the parsers rather than here, so
+# that loading the bot doesn't pay for them until a page is parsed,
+# which mostly happens in the worker processes.
+
+FORUM_URL = "https://modules.lancaster.ac.uk/mod/forum/view.php?id={}"
+DISCUSSION_URL = "https://modules.lancaster.ac.uk/mod/forum/discuss.php?d={}"
+
+_CLASS_XPATH = ".//*[contains(concat(' ', normalize-space(@class), ' '), ' {} ')]"
+
+
+def _parse(content):
+    """Parse a page, raising ValueError if it is empty or not HTML
+    like the parsers do for a page that is missing an element."""
+    import lxml.etree
+    import lxml.html
+
+    try:
+        return lxml.html.fromstring(content)
+    except lxml.etree.LxmlError as e:
+        raise ValueError(f"Could not parse the page: {e}") from e
+
+
+def _first(element, xpath):
+    """Get the first element matching an XPath expression."""
+    matches = element.xpath(xpath)
+    if not matches:
+        raise ValueError(f"No element matches {xpath!r}")
+    return matches[0]
+
+
+def _last_post_date(cells):
+    """The day of the latest post in a discussion, from the last cell
+    of its row. None if the page doesn't list it."""
+    divs = cells[-1].findall(".//div") if cells else []
+    try:
+        return datetime.datetime.strptime(divs[-1].text_content().strip(), "%d %b %Y")
+    except (IndexError, ValueError):
+        return None
+
+
+def parse_forum(content, since=None):
+    """Parses the announcements listed on a forum page.
+
+    If `since` is given, parsing stops at the first unpinned discussion
+    whose latest post was before the day before `since`. Discussions are
+    listed by their latest post, so any started or replied to since then
+    comes before it however many old ones have new replies. The page
+    only shows the day, and in its own timezone, hence the day's margin."""
+    document = _parse(content)
+    announcements = []
+    cutoff = since.date() - datetime.timedelta(days=1) if since else None
+    for row in _first(document, ".//tbody").iter("tr"):
+        icon, group, author, *other = row.findall(".//td")
+        if cutoff is not None and "pinned" not in row.get("class", "").split():
+            last_post = _last_post_date(other)
+            if last_post is not None and last_post.date() < cutoff:
+                break
+
+        if not group.text_content().strip():
+            title = _first(row, ".//th").text_content().strip()
+            avatar = _first(author, ".//img").attrib["src"]
+            _id = re.findall(
+                r"[?&]d=(\d+)$", _first(row, ".//th//a").attrib["href"].strip()
+            )[0]
+
+            if title.endswith("Locked"):
+                title = title[:-6]
+
+            author_info = _first(author, _CLASS_XPATH.format("author-info"))
+            author_name, date = author_info.findall(".//div")
+
+            announcement = {
+                "title": title.strip(),
+                "author": author_name.text_content().strip(),
+                "date": datetime.datetime.strptime(
+                    date.text_content().strip(), "%d %b %Y"
+                ),
+                "url": DISCUSSION_URL.format(_id),
+                "avatar": avatar,
+                "id": _id,
+            }
+            announcements.append(announcement)
+    return announcements
+
+
+def parse_discussion(content):
+    """Parses the description and date of a forum discussion."""
+    from dateutil.parser import isoparse
+
+    document = _parse(content)
+    container = _first(document, _CLASS_XPATH.format("post-content-container"))
+    return {
+        "description": "\n\n".join(
+            [p.text_content() for p in container.findall(".//p")]
+        )[:1000],
+        "date": isoparse(_first(document, ".//time[@datetime]").attrib["datetime"]),
+    }
+
+
+def parse_login_form(content):
+    """Parses the hidden fields of the portal login form."""
+    document = _parse(content)
+    form = _first(document, ".//form[@id='loginbox']")
+    return {f.attrib["name"]: f.attrib["value"] for f in form.iter("input")}
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+
+import aiohttp
+
+from . import moodle
+
+LOGIN_URL = "https://weblogin.lancs.ac.uk/login/"
+LOGIN_HOST = "weblogin.lancs.ac.uk"
+
+
+class PortalLoginError(Exception):
+    """Raised when the portal does not accept the login details."""
+
+
+class PortalSession:
+    """A long-lived HTTP session that is logged into the Lancaster
+    portal, logging in again whenever the session expires."""
+
+    def __init__(self, username, password, *, cookie_path=None, limit=10):
+        self.username = username
+        self.password = password
+        self.cookie_path = cookie_path
+        self.limit = limit
+        self.session = None
+        self.logged_in = False
+        self.logins = 0
+        self.logger = logging.getLogger(__name__)
+        self._login_lock = asyncio.Lock()
+
+    def _create_session(self):
+        cookie_jar = aiohttp.CookieJar()
+        if self.cookie_path and os.path.exists(self.cookie_path):
+            try:
+                cookie_jar.load(self.cookie_path)
+                self.logged_in = True
+            except Exception:
+                self.logger.warning("Could not load the saved portal cookies.")
+        connector = aiohttp.TCPConnector(
+            limit=self.limit, ttl_dns_cache=300, keepalive_timeout=60
+        )
+        self.session = aiohttp.ClientSession(connector=connector, cookie_jar=cookie_jar)
+
+    def save_cookies(self):
+        if self.cookie_path and self.session is not None:
+            self.session.cookie_jar.save(self.cookie_path)
+
+    async def login(self, logins=None):
+        """Log into the portal. Concurrent callers share a single login,
+        callers that saw `logins` logins before their session expired
+        don't log in again if someone else already has."""
+        async with self._login_lock:
+            if logins is not None and self.logins != logins:
+                return
+
+            self.logged_in = False
+            self.session.cookie_jar.clear()
+
+            async with self.session.get(LOGIN_URL) as login_page:
+                data = moodle.parse_login_form(await login_page.read())
+                data["username"] = self.username
+
+            async with self.session.post(LOGIN_URL, data=data) as pw_page:
+                data = moodle.parse_login_form(await pw_page.read())
+                data["password"] = self.password
+
+            async with self.session.post(LOGIN_URL, data=data) as resp:
+                html = await resp.text()
+            if "You are logged into" not in html:
+                raise PortalLoginError("The portal rejected the login details.")
+
+            self.logins += 1
+            self.logged_in = True
+            self.save_cookies()
+            self.logger.info("Logged into the portal.")
+
+    @staticmethod
+    def is_expired(resp):
+        """Whether a response was redirected to a login page."""
+        return resp.url.host == LOGIN_HOST or resp.url.path.startswith("/login")
+
+    @asynccontextmanager
+    async def get(self, url, **kwargs):
+        """Make a GET request as a logged in user."""
+        if self.session is None:
+            self._create_session()
+        if not self.logged_in:
+            await self.login(self.logins)
+
+        logins = self.logins
+        resp = await self.session.get(url, **kwargs)
+        if self.is_expired(resp):
+            resp.release()
+            self.logger.info("The portal session has expired.")
+            await self.login(logins)
+            resp = await self.session.get(url, **kwargs)
+            if self.is_expired(resp):
+                resp.release()
+                raise PortalLoginError("The portal session expired after logging in.")
+
+        try:
+            yield resp
+        finally:
+            resp.release()
+
+    async def close(self):
+        if self.session is not None:
+            self.save_cookies()
+            await self.session.close()
+            self.session = None
+            self.logged_in = False
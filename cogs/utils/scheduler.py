@@ -0,0 +1,55 @@
+import random
+import time
+from collections import deque
+
+
+class AdaptiveScheduler:
+    """Decides when each source should be polled next.
+
+    A source that had something new is polled again after `min_interval`
+    seconds, each quiet poll doubles its interval up to `max_interval`.
+    Intervals are jittered so polls don't line up, and no more than
+    `hourly_budget` polls are handed out in any hour."""
+
+    def __init__(
+        self,
+        min_interval=120,
+        max_interval=3600,
+        backoff=2,
+        jitter=0.1,
+        hourly_budget=120,
+    ):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.hourly_budget = hourly_budget
+        self.intervals = {}
+        self.next_poll = {}
+        self.polls = deque()
+
+    def remaining_budget(self, now):
+        while self.polls and self.polls[0] <= now - 3600:
+            self.polls.popleft()
+        return self.hourly_budget - len(self.polls)
+
+    def due(self, keys):
+        """Get the keys that are due to be polled, most overdue first,
+        limited by what is left of the hourly budget."""
+        now = time.monotonic()
+        due = [k for k in keys if self.next_poll.get(k, now) <= now]
+        due.sort(key=lambda k: self.next_poll.get(k, now))
+        due = due[: max(0, self.remaining_budget(now))]
+        self.polls.extend([now] * len(due))
+        return due
+
+    def record(self, key, active):
+        """Schedule the next poll of a key, `active` is whether
+        the last poll found anything new."""
+        if active or key not in self.intervals:
+            interval = self.min_interval
+        else:
+            interval = min(self.max_interval, self.intervals[key] * self.backoff)
+        self.intervals[key] = interval
+        jitter = random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.next_poll[key] = time.monotonic() + interval * jitter
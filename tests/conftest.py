@@ -0,0 +1,104 @@
+"""Stand-ins for the bot and the Moodle forums, shared by the tests
+of the Lancaster cog."""
+
+import asyncio
+import contextlib
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+ROW = """
+<tr class="discussion">
+  <th class="topic"><a href="https://modules.lancaster.ac.uk/mod/forum/discuss.php?d={id}">Post {id}</a></th>
+  <td class="icon"></td>
+  <td class="group"></td>
+  <td class="author">
+    <img src="https://example.com/avatar.png">
+    <div class="author-info"><div>Author {id}</div><div>{day} Jan 2021</div></div>
+  </td>
+  <td class="replies"><span>0</span></td>
+  <td class="lastpost"><div>Author {id}</div><div>{day} Jan 2021</div></td>
+</tr>
+"""
+
+
+def forum_page(forum_id, posts):
+    """A page listing `posts` discussions newest first, the nth one
+    has the ID forum_id * 100 + n and was posted on n + 1 Jan."""
+    rows = "".join(
+        ROW.format(id=forum_id * 100 + n, day=n + 1) for n in reversed(range(posts))
+    )
+    return f"<html><body><table><tbody>{rows}</tbody></table></body></html>"
+
+
+def forum_view(delay, posts):
+    """A view of the forum pages that answers after `delay` seconds.
+    A negative forum ID fails and forum 0 takes ten times as long."""
+
+    async def view(request):
+        forum_id = int(request.query["id"])
+        if forum_id < 0:
+            raise web.HTTPInternalServerError()
+        await asyncio.sleep(delay * 10 if forum_id == 0 else delay)
+        page = forum_page(forum_id, posts.get(forum_id, 3))
+        return web.Response(text=page, content_type="text/html")
+
+    return view
+
+
+class StandInBot:
+    """Just enough of LancasterUniBot for the cog to fetch forums."""
+
+    def __init__(self, **options):
+        from bot import DEFAULT_OPTIONS
+        from cogs.utils.executor import Executors
+
+        self.options = {
+            **DEFAULT_OPTIONS,
+            "details_cache": "memory",
+            "portal_cookie_file": "",
+            **options,
+        }
+        self.login_data = ("username", "password")
+        self.executors = Executors(threads=4, processes=0)
+
+    async def wait_until_ready(self):
+        # The cog's setup isn't needed to fetch forums.
+        await asyncio.Event().wait()
+
+
+@contextlib.asynccontextmanager
+async def serve_cog(delay=0, posts=None, **options):
+    """A Lancaster cog fetching forums through a stand-in server that
+    answers after `delay` seconds, `posts` maps a forum ID to how many
+    discussions it has if not 3."""
+    from cogs.lancaster import Lancaster
+    from cogs.utils import moodle
+
+    app = web.Application()
+    app.router.add_get("/mod/forum/view.php", forum_view(delay, posts or {}))
+    server = TestServer(app)
+    await server.start_server()
+    bot = StandInBot(**options)
+    cog = Lancaster(bot)
+    cog.portal.logged_in = True
+    url = moodle.FORUM_URL
+    moodle.FORUM_URL = str(server.make_url("/mod/forum/view.php")) + "?id={}"
+    try:
+        yield cog
+    finally:
+        moodle.FORUM_URL = url
+        await cog.portal.close()
+        await server.close()
+        bot.executors.shutdown()
+
+
+@pytest.fixture
+def stand_in_bot():
+    return StandInBot
+
+
+@pytest.fixture
+def stand_in_cog():
+    return serve_cog
@@ -0,0 +1,127 @@
+"""Database and DBQuery against a real Postgres, the URL of a scratch
+database is read from TEST_DATABASE_URL."""
+
+import asyncio
+import os
+
+import pytest
+
+pytest.importorskip("asyncpg")
+
+from cogs.utils.db import Database
+from cogs.utils.db.database import DBFilter
+from cogs.utils.db.fields import BigInteger, Index, Text
+
+URL = os.environ.get("TEST_DATABASE_URL")
+
+pytestmark = pytest.mark.skipif(URL is None, reason="TEST_DATABASE_URL is not set")
+
+TABLE = "test_database"
+
+
+def run_with_table(test):
+    async def run():
+        database = Database(URL)
+        await database.connect()
+        table = await database.new_table(
+            TABLE,
+            (
+                BigInteger("guild_id"),
+                Text("post_id"),
+                Text("value"),
+                Index("guild_id", "post_id", unique=True),
+            ),
+        )
+        try:
+            await test(database, table)
+        finally:
+            await database.execute_sql(f"DROP TABLE {TABLE}")
+            await database.close()
+
+    asyncio.run(run())
+
+
+def test_new_records_returns_count():
+    async def test(database, table):
+        records = [{"guild_id": 1, "post_id": str(n), "value": "a"} for n in range(50)]
+        assert await table.new_records(records) == 50
+        assert await table.new_records([]) == 0
+
+    run_with_table(test)
+
+
+def test_upsert_many_counts_inserts_and_updates():
+    async def test(database, table):
+        conflict = ("guild_id", "post_id")
+        records = [{"guild_id": 1, "post_id": str(n), "value": "a"} for n in range(5)]
+        assert await table.upsert_many(conflict, records) == 5
+        records[0]["value"] = "b"
+        assert await table.upsert_many(conflict, records[:2]) == 2
+        rows = await table.filter(where=DBFilter(guild_id=1, post_id="0"))
+        assert rows[0]["value"] == "b"
+
+    run_with_table(test)
+
+
+def test_upsert_many_does_not_count_skipped_records():
+    async def test(database, table):
+        conflict = ("guild_id", "post_id")
+        records = [{"guild_id": 1, "post_id": str(n)} for n in range(3)]
+        assert await table.upsert_many(conflict, records) == 3
+        assert await table.upsert_many(conflict, records) == 0
+
+    run_with_table(test)
+
+
+def test_upsert_many_uses_the_last_duplicate():
+    async def test(database, table):
+        conflict = ("guild_id", "post_id")
+        records = [
+            {"guild_id": 1, "post_id": "1", "value": "a"},
+            {"guild_id": 1, "post_id": "1", "value": "b"},
+        ]
+        assert await table.upsert_many(conflict, records) == 1
+        rows = await table.all()
+        assert [r["value"] for r in rows] == ["b"]
+
+    run_with_table(test)
+
+
+def test_every_statement_is_recorded():
+    async def test(database, table):
+        records = [{"guild_id": 1, "post_id": str(n), "value": "a"} for n in range(250)]
+        await table.new_records(records)
+        assert len([r async for r in table.iter_all(prefetch=100)]) == 250
+        recorded = {sql: rows for (sql, _), rows in database.query_rows.items()}
+        assert recorded[f"COPY {TABLE} (guild_id, post_id, value) FROM STDIN;"] == 250
+        assert recorded[f"SELECT * FROM {TABLE}   ;"] == 250
+        assert any(
+            sql.startswith(f"CREATE TABLE IF NOT EXISTS {TABLE}") for sql in recorded
+        )
+        assert any(sql.startswith("CREATE UNIQUE INDEX") for sql in recorded)
+
+    run_with_table(test)
+
+
+def test_new_table_only_alters_for_missing_columns():
+    async def test(database, table):
+        statements = []
+        execute = database.execute
+
+        async def recording_execute(sql, *args, **kwargs):
+            statements.append(sql)
+            return await execute(sql, *args, **kwargs)
+
+        database.execute = recording_execute
+        fields = [BigInteger("guild_id"), Text("post_id"), Text("value")]
+        database.tables.clear()
+        await database.new_table(TABLE, fields)
+        assert not any(sql.startswith("ALTER") for sql in statements)
+        database.tables.clear()
+        await database.new_table(TABLE, fields + [Text("extra")])
+        assert [sql for sql in statements if sql.startswith("ALTER")] == [
+            f'ALTER TABLE {TABLE} ADD COLUMN IF NOT EXISTS "extra" TEXT;'
+        ]
+        assert "extra" in await database.column_types(TABLE)
+
+    run_with_table(test)
@@ -0,0 +1,109 @@
+"""Choosing, sending and retrying the announcements of a pass."""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("discord")
+
+from cogs.lancaster import Lancaster
+
+
+def failing_pass(cog, pending, sent=()):
+    deliveries = {
+        guild_id: [(post_id, None) for post_id in posts]
+        for guild_id, posts in pending.items()
+    }
+    results = [[p for p in posts if p in sent] for posts in pending.values()]
+    cog.record_failures(pending, deliveries, results)
+
+
+async def make_cog(stand_in_bot):
+    return Lancaster(stand_in_bot(delivery_attempts="3"))
+
+
+def test_failures_are_retried_until_they_give_up(stand_in_bot):
+    cog = asyncio.run(make_cog(stand_in_bot))
+    pending = {1: {"10": {"id": "10"}}, 2: {"10": {"id": "10"}}}
+    failing_pass(cog, pending)
+    assert set(cog.failed_deliveries) == {(1, "10"), (2, "10")}
+    failing_pass(cog, pending)
+    assert cog.failed_deliveries[(1, "10")][1] == 2
+    failing_pass(cog, pending)
+    assert cog.failed_deliveries == {}
+
+
+def test_sent_deliveries_are_not_retried(stand_in_bot):
+    cog = asyncio.run(make_cog(stand_in_bot))
+    failing_pass(cog, {1: {"10": {"id": "10"}, "11": {"id": "11"}}}, sent={"10"})
+    assert set(cog.failed_deliveries) == {(1, "11")}
+
+
+class StandInTable:
+    """Keeps the records given to `upsert_many`, `filter` returns
+    them after the records it was created with."""
+
+    def __init__(self, records=()):
+        self.records = list(records)
+        self.upserted = []
+
+    async def filter(self, where, **kwargs):
+        return self.records + self.upserted
+
+    async def upsert_many(self, conflict, records):
+        self.upserted += records
+        return len(records)
+
+
+class StandInChannel:
+    id = 1
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, embed):
+        await asyncio.sleep(0.01)
+        self.sent.append(embed.title)
+
+
+async def check(stand_in_cog, forums, marks, passes=1, posts=None):
+    """Run passes at once over the forums with the given high-water
+    marks, returns the titles sent to a guild's announcement channel."""
+    async with stand_in_cog(posts=posts) as cog:
+        channel = StandInChannel()
+        cog.bot.shard_ids = None
+        cog.bot.database = SimpleNamespace(
+            leader_election=lambda name: SimpleNamespace(name=name)
+        )
+        cog.bot.owned_guilds = lambda: [SimpleNamespace(id=1)]
+        cog.moodle_posts = StandInTable()
+        cog.forum_marks = StandInTable(
+            {"scope": "announcements", "forum_id": f, "post_id": p}
+            for f, p in marks.items()
+        )
+
+        async def get_announcement_channels(guilds):
+            return {1: channel}
+
+        async def get_extra_details(_id):
+            return None
+
+        cog.get_announcement_channels = get_announcement_channels
+        cog.get_extra_details = get_extra_details
+        forums = [{"id": f, "name": str(f)} for f in forums]
+        await asyncio.gather(
+            *[cog.check_for_announcements(forums) for _ in range(passes)]
+        )
+        return channel.sent
+
+
+def test_busy_forum_does_not_push_out_another_forums_post(stand_in_cog):
+    # Every discussion of forum 1 is new, only the newest of forum 2.
+    sent = asyncio.run(check(stand_in_cog, [1, 2], {1: 99, 2: 201}, posts={1: 8}))
+    assert sorted(sent) == sorted([f"Post {100 + n}" for n in range(8)] + ["Post 202"])
+
+
+def test_overlapping_passes_send_each_post_once(stand_in_cog):
+    sent = asyncio.run(check(stand_in_cog, [1], {1: 100}, passes=2))
+    assert sorted(sent) == ["Post 101", "Post 102"]
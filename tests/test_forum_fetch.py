@@ -0,0 +1,89 @@
+"""Lancaster.get_news against a local stand-in for the Moodle forums."""
+
+import asyncio
+import datetime
+import time
+
+import pytest
+
+pytest.importorskip("discord")
+
+DELAY = 0.2
+JAN_3 = datetime.datetime(2021, 1, 3)
+
+
+async def fetch_news(stand_in_cog, forums, **options):
+    """Fetch the forums through the stand-in server, returns the
+    announcements and the time it took."""
+    async with stand_in_cog(delay=DELAY, **options) as cog:
+        start = time.perf_counter()
+        news = await cog.get_news([{"id": i, "name": str(i)} for i in forums])
+        return news, time.perf_counter() - start
+
+
+async def fetch_twice(stand_in_cog, first, second):
+    """Fetch the same unchanged forum since two different times."""
+    async with stand_in_cog() as cog:
+        forum = {"id": 1, "name": "1"}
+        await cog.fetch_forum(forum, first)
+        return await cog.fetch_forum(forum, second), cog.forum_stats[1]
+
+
+def test_wall_time_stays_flat(stand_in_cog):
+    options = {"forum_concurrency": "50"}
+    few, few_time = asyncio.run(fetch_news(stand_in_cog, range(1, 6), **options))
+    many, many_time = asyncio.run(fetch_news(stand_in_cog, range(1, 41), **options))
+    assert len(few) == 5 * 3
+    assert len(many) == 40 * 3
+    # One forum after another would take 40 * DELAY.
+    assert many_time < max(few_time * 3, DELAY * 5)
+
+
+def test_concurrency_is_bounded(stand_in_cog):
+    _, elapsed = asyncio.run(
+        fetch_news(stand_in_cog, range(1, 11), forum_concurrency="2")
+    )
+    assert elapsed >= DELAY * 5
+
+
+def test_results_are_merged_newest_first(stand_in_cog):
+    news, _ = asyncio.run(fetch_news(stand_in_cog, range(1, 4)))
+    dates = [n["date"] for n in news]
+    assert dates == sorted(dates, reverse=True)
+    assert {n["forum"] for n in news} == {1, 2, 3}
+
+
+def test_failing_and_slow_forums_are_skipped(stand_in_cog):
+    news, elapsed = asyncio.run(
+        fetch_news(
+            stand_in_cog, [-1, 0, 1, 2], forum_retries="0", forum_timeout=str(DELAY * 3)
+        )
+    )
+    assert {n["forum"] for n in news} == {1, 2}
+    assert elapsed < DELAY * 10
+
+
+def test_unchanged_page_is_reused_since_a_later_time(stand_in_cog):
+    news, stats = asyncio.run(
+        fetch_twice(stand_in_cog, JAN_3, JAN_3 + datetime.timedelta(days=1))
+    )
+    # Parsing stops a day before `since`, at the discussion from 1 Jan.
+    assert [n["id"] for n in news] == ["102", "101"]
+    assert stats["unchanged"] == 1
+
+
+def test_unchanged_page_is_parsed_again_since_an_earlier_time(stand_in_cog):
+    news, stats = asyncio.run(fetch_twice(stand_in_cog, JAN_3, None))
+    assert [n["id"] for n in news] == ["102", "101", "100"]
+    assert stats["parsed"] == 2
+
+
+async def poll(stand_in_cog, scheduled):
+    async with stand_in_cog() as cog:
+        await cog.get_news([{"id": 1, "name": "1"}], scheduled=scheduled)
+        return cog.scheduler.intervals
+
+
+def test_only_scheduled_polls_move_the_schedule(stand_in_cog):
+    assert asyncio.run(poll(stand_in_cog, scheduled=False)) == {}
+    assert asyncio.run(poll(stand_in_cog, scheduled=True)) == {1: 120}
@@ -0,0 +1,57 @@
+"""The event loop keeps its heartbeat while a poll's pages are parsed."""
+
+import asyncio
+import os
+
+from cogs.utils import moodle
+from cogs.utils.executor import Executors
+from cogs.utils.metrics import LoopLagMonitor
+
+FORUMS = 10
+
+with open(
+    os.path.join(os.path.dirname(__file__), "fixtures", "forum_large.html"), "rb"
+) as f:
+    PAGE = f.read()
+
+
+async def parse_on_loop(executors):
+    return [moodle.parse_forum(PAGE) for _ in range(FORUMS)]
+
+
+async def parse_in_executor(executors):
+    return await asyncio.gather(
+        *[executors.run_in_process(moodle.parse_forum, PAGE) for _ in range(FORUMS)]
+    )
+
+
+def max_lag_during(poll):
+    """Run a poll with the loop lag monitor running, returns the
+    longest the loop was late for a heartbeat."""
+
+    async def run():
+        executors = Executors(threads=2, processes=2)
+        monitor = LoopLagMonitor(interval=0.01, threshold=1)
+        try:
+            # Start the worker processes before measuring.
+            await parse_in_executor(executors)
+            monitor.start(asyncio.get_running_loop())
+            await asyncio.sleep(0.05)
+            announcements = await poll(executors)
+            await asyncio.sleep(0.05)
+        finally:
+            monitor.stop()
+            executors.shutdown()
+        assert all(len(a) == len(announcements[0]) for a in announcements)
+        return max(monitor.lag.recent)
+
+    return asyncio.run(run())
+
+
+def test_parsing_on_the_loop_delays_heartbeats():
+    # Shows the measurement can see a blocked loop.
+    assert max_lag_during(parse_on_loop) > 0.1
+
+
+def test_parsing_in_the_executor_keeps_heartbeats():
+    assert max_lag_during(parse_in_executor) < 0.05
@@ -0,0 +1,104 @@
+"""The lxml Moodle parsers against saved pages."""
+
+import datetime
+import os
+
+import pytest
+
+from cogs.utils import moodle
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        return f.read()
+
+
+@pytest.fixture(scope="module")
+def soup_parsers():
+    pytest.importorskip("bs4")
+    from bench import soup_parsers
+
+    return soup_parsers
+
+
+@pytest.mark.parametrize("name", ["forum.html", "forum_large.html"])
+def test_forum_matches_beautifulsoup(soup_parsers, name):
+    content = fixture(name)
+    announcements = moodle.parse_forum(content)
+    assert announcements
+    assert announcements == soup_parsers.parse_forum(content.decode())
+
+
+def test_discussion_matches_beautifulsoup(soup_parsers):
+    content = fixture("discussion.html")
+    assert moodle.parse_discussion(content) == soup_parsers.parse_discussion(
+        content.decode()
+    )
+
+
+def test_login_form_matches_beautifulsoup(soup_parsers):
+    content = fixture("login.html")
+    assert moodle.parse_login_form(content) == soup_parsers.parse_login_form(
+        content.decode()
+    )
+
+
+def test_forum_skips_group_posts_and_locked_suffix():
+    announcements = moodle.parse_forum(fixture("forum.html"))
+    content = fixture("forum.html").decode()
+    assert len(announcements) < content.count('data-region="discussion-list-item"')
+    assert not any(a["title"].endswith("Locked") for a in announcements)
+
+
+def test_forum_since_stops_at_discussions_without_new_posts():
+    content = fixture("forum_large.html")
+    announcements = moodle.parse_forum(content)
+    new = moodle.parse_forum(content, since=datetime.datetime(2020, 12, 20))
+    # The discussions in the fixture have no replies, so their date
+    # is also their latest post.
+    cutoff = datetime.datetime(2020, 12, 19)
+    assert new == announcements[: len(new)]
+    assert all(a["date"] >= cutoff for a in new)
+    assert announcements[len(new)]["date"] < cutoff
+
+
+ROW = """
+<tr class="discussion">
+  <th><a href="https://modules.lancaster.ac.uk/mod/forum/discuss.php?d={id}">Post</a></th>
+  <td></td>
+  <td class="group"></td>
+  <td class="author">
+    <img src="https://example.com/avatar.png">
+    <div class="author-info"><div>Author</div><div>{posted}</div></div>
+  </td>
+  <td><span>1</span></td>
+  <td><div>Author</div><div>{last_post}</div></td>
+</tr>
+"""
+
+
+def test_forum_since_finds_new_discussions_below_old_replies():
+    # Replies have brought three old discussions above a new one.
+    rows = [
+        ROW.format(id=1, posted="1 Nov 2020", last_post="10 Jan 2021"),
+        ROW.format(id=2, posted="2 Nov 2020", last_post="10 Jan 2021"),
+        ROW.format(id=3, posted="3 Nov 2020", last_post="9 Jan 2021"),
+        ROW.format(id=50, posted="9 Jan 2021", last_post="9 Jan 2021"),
+        ROW.format(id=4, posted="4 Nov 2020", last_post="1 Dec 2020"),
+    ]
+    content = f"<table><tbody>{''.join(rows)}</tbody></table>".encode()
+    new = moodle.parse_forum(content, since=datetime.datetime(2021, 1, 9, 12))
+    assert [a["id"] for a in new] == ["1", "2", "3", "50"]
+
+
+def test_forum_since_none_parses_everything():
+    content = fixture("forum.html")
+    assert moodle.parse_forum(content, since=None) == moodle.parse_forum(content)
+
+
+@pytest.mark.parametrize("content", [b"", b"   ", b"<html><body></body></html>"])
+def test_malformed_discussion_raises_value_error(content):
+    with pytest.raises(ValueError):
+        moodle.parse_discussion(content)
@@ -0,0 +1,57 @@
+"""AdaptiveScheduler with a stand-in clock."""
+
+import pytest
+
+from cogs.utils import scheduler as scheduler_module
+from cogs.utils.scheduler import AdaptiveScheduler
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(scheduler_module.time, "monotonic", lambda: now[0])
+    return now
+
+
+def make_scheduler(**kwargs):
+    return AdaptiveScheduler(min_interval=100, max_interval=700, jitter=0, **kwargs)
+
+
+def test_quiet_polls_back_off_up_to_the_maximum(clock):
+    scheduler = make_scheduler()
+    intervals = []
+    for _ in range(6):
+        scheduler.record("forum", active=False)
+        intervals.append(scheduler.intervals["forum"])
+    assert intervals == [100, 200, 400, 700, 700, 700]
+    assert scheduler.next_poll["forum"] == clock[0] + 700
+
+
+def test_activity_resets_to_the_minimum(clock):
+    scheduler = make_scheduler()
+    for _ in range(4):
+        scheduler.record("forum", active=False)
+    scheduler.record("forum", active=True)
+    assert scheduler.intervals["forum"] == 100
+    assert scheduler.due(["forum"]) == []
+    clock[0] += 100
+    assert scheduler.due(["forum"]) == ["forum"]
+
+
+def test_hourly_budget_caps_polls(clock):
+    scheduler = make_scheduler(hourly_budget=3)
+    keys = list(range(10))
+    assert len(scheduler.due(keys)) == 3
+    clock[0] += 1800
+    assert scheduler.due(keys) == []
+    clock[0] += 1800
+    assert len(scheduler.due(keys)) == 3
+
+
+def test_most_overdue_first(clock):
+    scheduler = make_scheduler()
+    scheduler.record("a", active=False)
+    clock[0] += 50
+    scheduler.record("b", active=False)
+    clock[0] += 200
+    assert scheduler.due(["b", "a", "c"]) == ["a", "b", "c"]